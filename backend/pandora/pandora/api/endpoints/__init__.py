@@ -5,4 +5,5 @@ from .account import *
 from .auth import *
 from .version import *
 from .audit import *
+from .permissions import *
 
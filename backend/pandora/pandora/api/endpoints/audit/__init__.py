@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from .token import *
\ No newline at end of file
+from .token import *
+from .cache import *
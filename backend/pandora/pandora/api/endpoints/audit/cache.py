@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from pandora.core.endpoints.view import AuthBaseEndpoint
+from pandora.core.permissions import SuperuserPermission
+from pandora.core.response import APIResponse
+from pandora.core.cachedependency.stats import stats, get_global_stats
+from pandora.core.cachedependency.client import mapping
+from pandora.utils.localcache import get_local_caches
+from pandora.business.company import get_unknown_company_stats
+
+__all__ = ["AuditCacheStatsEndpoint"]
+
+
+class AuditCacheStatsEndpoint(AuthBaseEndpoint):
+    permission_classes = (SuperuserPermission,)
+    no_company = True
+    company_invade_filter = False
+    company_invade_data = False
+    action_map = {
+        "get": "retrieve"
+    }
+
+    def get(self, request, *args, **kwargs):
+        """
+        获取API缓存统计(当前worker及全局)
+        """
+        return APIResponse({
+            "worker": stats.snapshot(),
+            "local_caches": [local_cache.info() for local_cache in get_local_caches().values()],
+            "dependents": mapping.get_cache_info(),
+            "global": get_global_stats(),
+            "unknown_companies": get_unknown_company_stats(),
+        })
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from django.utils.translation import gettext_lazy as _
-from django.db import transaction
 from django.db.models import Q
 from pandora.core.endpoints import viewset
 from pandora.api import serializers
@@ -10,7 +9,7 @@ from pandora.core.schema import RemoveResponseSerializer
 from pandora.core.response import APIResponse
 from pandora.core.schema import default_parameters
 from pandora.utils.decorators import action, swagger_auto_schema
-from pandora.utils.cacheutils import delete_expire_token
+from pandora.business.token import revoke_tokens
 from pandora.core.code import BAD_REQUEST
 
 
@@ -44,17 +43,11 @@ class AuditTokenRevokeViewSet(viewset.GenericViewSet):
         data = request.data
         tokens = data.get("token", [])
         dest_tokens = Token.objects.filter(uid__in=tokens, )
-        dest_tokens_ids = [a.uid for a in dest_tokens]
 
-        if len(tokens) != len(dest_tokens_ids):
+        if len(tokens) != dest_tokens.count():
             return APIResponse(code=BAD_REQUEST, message=_("存在无效令牌"))
 
-        with transaction.atomic():
-            deleted = 0
-            for token in dest_tokens:
-                delete_expire_token(token.key)
-                token.delete(soft=False)
-                deleted += 1
+        deleted = revoke_tokens(dest_tokens, soft=False)
 
         return APIResponse(data={
             "remove": deleted
@@ -13,5 +13,6 @@ router.register("token", eps.AuditTokenRevokeViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
+    path("cache/stats/", eps.AuditCacheStatsEndpoint.as_view()),
 
 ]
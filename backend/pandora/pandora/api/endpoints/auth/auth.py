@@ -14,7 +14,9 @@ from pandora.core.response import APIResponse
 from pandora.utils.typeutils import errors2string
 from pandora.api.serializers.auth import LoginUserSerializer
 from pandora.core.code import BAD_REQUEST
-from pandora.utils.cacheutils import delete_expire_token, set_expire_token
+from pandora.utils.cacheutils import revoke_user_signed_tokens
+from pandora.business.token import revoke_tokens
+from pandora.core.authentication import SIGNED_TOKEN_ON
 from pandora.business.auth import get_remote_ip, get_user_agent_info
 from pandora.core.code import AUTHENTICATION_FAILED
 
@@ -33,8 +35,9 @@ class AuthLogoutEndpoint(AuthBaseEndpoint):
         """
         退出(Session)
         """
-        tokens = Token.objects.filter(user=request.user)
-        for token in tokens:
-            delete_expire_token(token.key)
-            token.delete()
+        revoke_tokens(Token.objects.filter(user_id=request.user.pk))
+        if SIGNED_TOKEN_ON:
+            # 签名token的request.auth为payload
+            exp = request.auth.get("exp") if isinstance(request.auth, dict) else None
+            revoke_user_signed_tokens(request.user.pk, exp)
         return APIResponse()
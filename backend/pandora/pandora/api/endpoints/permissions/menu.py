@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from rest_framework.permissions import IsAuthenticated
+from pandora.core.endpoints.view import AuthBaseEndpoint
+from pandora.core.header import get_project_label
+from pandora.core.permissions import ActivePermission, CatalogPermission
+from pandora.core.response import APIResponse
+from pandora.business.menu import get_user_menu_tree, find_menu_node
+from pandora.business.permission import PERMISSION_MENU
+
+__all__ = ["PermissionMenuTreeEndpoint", "PermissionMenuSubtreeEndpoint"]
+
+
+class PermissionMenuTreeEndpoint(AuthBaseEndpoint):
+    no_company = True
+    company_invade_filter = False
+    company_invade_data = False
+    action_map = {
+        "get": "retrieve"
+    }
+
+    def get(self, request, *args, **kwargs):
+        """
+        获取当前用户在项目(APP_HEADER)下有读权限的菜单树
+        """
+        client_id = get_project_label(request)
+        if not client_id:
+            return APIResponse([])
+        return APIResponse(get_user_menu_tree(request.user.pk, client_id))
+
+
+class PermissionMenuSubtreeEndpoint(AuthBaseEndpoint):
+    permission_classes = (ActivePermission, IsAuthenticated, CatalogPermission)
+    catalog_permission = (PERMISSION_MENU, "menu_id")
+    no_company = True
+    company_invade_filter = False
+    company_invade_data = False
+    action_map = {
+        "get": "retrieve"
+    }
+
+    def get(self, request, *args, **kwargs):
+        """
+        获取当前用户可见的某个菜单的子树
+        """
+        tree = get_user_menu_tree(request.user.pk, get_project_label(request))
+        return APIResponse(find_menu_node(tree, kwargs["menu_id"]))
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.urls import path
+from django.urls import include
+
+from pandora.api import endpoints as eps
+from pandora.core.routers import APIRouter
+
+router = APIRouter()
+
+urlpatterns = [
+    path("", include(router.urls)),
+    path("menu/tree/", eps.PermissionMenuTreeEndpoint.as_view()),
+    path("menu/<int:menu_id>/tree/", eps.PermissionMenuSubtreeEndpoint.as_view()),
+
+]
@@ -14,6 +14,7 @@ urlpatterns = [
 
     path("", include("pandora.api.endpoints.auth.urls")),
     path("audit/", include("pandora.api.endpoints.audit.urls")),
+    path("permissions/", include("pandora.api.endpoints.permissions.urls")),
     path("version/", eps.VersionEndpoint.as_view()),
 
 ]
@@ -1,3 +1,1172 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import pickle
+import time
+import uuid
+from unittest import mock, skipIf
+from django.db import OperationalError, connection, models, transaction
+from django.db.models.signals import m2m_changed, post_delete
+from django.conf import settings
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase
+from rest_framework.test import force_authenticate
+from django.utils import timezone
+from django.utils.http import quote_etag
+from pandora.api.endpoints import PermissionMenuTreeEndpoint, PermissionMenuSubtreeEndpoint
+from pandora.core.cachedependency import cache as table_cache
+from pandora.core.cachedependency import client as cache_client
+from pandora.core.cachedependency import dependents as dp
+from pandora.core.cachedependency import stats as cache_stats
+from pandora.business import company as company_business
+from pandora.business import menu as menu_business
+from pandora.business import permission as permission_business
+from pandora.business.token import reap_expired_tokens, revoke_tokens
+from pandora.core.authentication import ExpiringTokenAuthentication
+from pandora.core.code import AUTHENTICATION_FAILED
+from pandora.core.exceptions import AuthenticationFailed
+from pandora.core.middleware import company as company_middleware
+from pandora.core.middleware.etag import ConditionalEtagCacheMiddleware
+from pandora.core.models import CoreModel
+from pandora.core import permissions
+from pandora.core.signal import post_soft_delete
+from pandora.core.user import CachedPrincipal
+from pandora.management.commands import api_cache_graph
+from pandora.models import Company, Token, User, Menu, Module, CatalogPermissionGroup, CatalogPermissionGroupMember
+from pandora.models import CatalogPermissionGroupMenu, CatalogPermissionGroupModule
+from pandora.models.collection import ActionMode, CommonStatus
+from pandora.utils import cacheutils, localcache
 
-# Create your tests here.
+
+@skipIf(table_cache.TABLE_LAYOUT == table_cache.TABLE_LAYOUT_HASH, "hash布局不使用脚本")
+class TableVersionResolveTest(SimpleTestCase):
+    """
+    Lua脚本和pipeline回退读取表版本的结果一致
+    """
+
+    def setUp(self):
+        prefix = "TEST_TABLE_{}".format(uuid.uuid4().hex)
+        self.keys = ["{}_{}".format(prefix, i) for i in range(4)]
+
+    def tearDown(self):
+        table_cache.cache.delete_many(self.keys)
+
+    def test_missing_keys_initialized(self):
+        for resolve in (table_cache._resolve_by_script, table_cache._resolve_by_pipeline):
+            table_cache.cache.delete_many(self.keys)
+            self.assertEqual(resolve(self.keys, 100), dict.fromkeys(self.keys, 100))
+            self.assertEqual(table_cache.cache.get_many(self.keys), dict.fromkeys(self.keys, 100))
+
+    def test_existing_keys_kept(self):
+        table_cache.set_table_last_modify(self.keys[0], 7)
+        table_cache.set_table_last_modify(self.keys[1], 8)
+        by_script = table_cache._resolve_by_script(self.keys, 100)
+        self.assertEqual(by_script, {self.keys[0]: 7, self.keys[1]: 8, self.keys[2]: 100, self.keys[3]: 100})
+        # 脚本已初始化的key不会被pipeline用新的种子覆盖
+        self.assertEqual(table_cache._resolve_by_pipeline(self.keys, 200), by_script)
+
+    def test_incr_after_resolve(self):
+        table_cache._resolve_by_script(self.keys[:1], 100)
+        self.assertEqual(table_cache.incr_tables_last_modify(self.keys[:1]), [101])
+        self.assertEqual(table_cache._resolve_by_pipeline(self.keys[:1], 200), {self.keys[0]: 101})
+
+
+class MatchPathTest(SimpleTestCase):
+    """
+    前缀树匹配与逐个正则匹配的结果一致
+    """
+
+    ROUTES = [
+        "/api/<str:version>/user/",
+        "/api/<str:version>/user/<int:pk>/",
+        "/api/<str:version>/user/me/",
+        "/api/<str:version>/user/<str:name>/profile/",
+        "/api/<str:version>/user/me/profile/",
+        "/api/<str:version>/menu/<int:pk>/",
+        "/api/<str:version>/menu/<str:name>/",
+        "/api/<str:version>/menu/tree/",
+        "/api/<path:rest>/",
+    ]
+
+    def setUp(self):
+        self.mapping = dp.Dependents()
+        for route in self.ROUTES:
+            self.mapping.register(route=route, dependents=[])
+
+    def assertSameMatch(self, path, route):
+        self.assertEqual(self.mapping.match_path(path), route, path)
+        self.assertEqual(self.mapping.match_path_linear(path), route, path)
+
+    def test_static(self):
+        self.assertSameMatch("/api/v1/user/", "/api/<str:version>/user/")
+        self.assertSameMatch("/api/v1/menu/tree/", "/api/<str:version>/menu/tree/")
+
+    def test_converter(self):
+        self.assertSameMatch("/api/v1/user/12/", "/api/<str:version>/user/<int:pk>/")
+        self.assertSameMatch("/api/v1/menu/12/", "/api/<str:version>/menu/<int:pk>/")
+        self.assertSameMatch("/api/v1/menu/main/", "/api/<str:version>/menu/<str:name>/")
+        self.assertSameMatch("/api/v1/user/tom/profile/", "/api/<str:version>/user/<str:name>/profile/")
+
+    def test_static_before_param(self):
+        self.assertSameMatch("/api/v1/user/me/", "/api/<str:version>/user/me/")
+        self.assertSameMatch("/api/v1/user/me/profile/", "/api/<str:version>/user/me/profile/")
+        # 静态分段与路由关键字同名的参数值
+        self.assertSameMatch("/api/me/user/3/", "/api/<str:version>/user/<int:pk>/")
+
+    def test_miss(self):
+        for path in ("/other/v1/user/", "/api/v1/user/tom/", "/api/v1/user/1/2/3/4/"):
+            self.assertFalse(self.mapping.match_path(path), path)
+            self.assertFalse(self.mapping.match_path_linear(path), path)
+
+    def test_register_clears_cache(self):
+        self.assertFalse(self.mapping.match_path("/api/v1/group/"))
+        self.mapping.register(route="/api/<str:version>/group/", dependents=[])
+        self.assertSameMatch("/api/v1/group/", "/api/<str:version>/group/")
+
+
+class SignedTokenRevokeTest(SimpleTestCase):
+    """
+    按用户撤销签名token时, 只有严格早于撤销时间(毫秒)签发的token失效
+    """
+
+    REVOKED_AT = 1700000000.5
+
+    def setUp(self):
+        self.uid = "test-{}".format(uuid.uuid4().hex)
+        self.jti = uuid.uuid4().hex
+        # 只替换cacheutils引用的time, 不影响缓存后端的过期时间
+        with mock.patch.object(cacheutils, "time") as mock_time:
+            mock_time.time.return_value = self.REVOKED_AT
+            cacheutils.revoke_user_signed_tokens(self.uid, self.REVOKED_AT + 60)
+
+    def tearDown(self):
+        cacheutils.cache.delete_many(["IDAAS:REVOKED-USER-{}".format(self.uid), "IDAAS:REVOKED-{}".format(self.jti)])
+        cacheutils.signed_token_revoked_cache.invalidate(["USER-{}".format(self.uid), self.jti])
+
+    def test_issued_before_revoke(self):
+        revoked_ms = int(self.REVOKED_AT * 1000)
+        self.assertTrue(cacheutils.is_signed_token_revoked(self.jti, self.uid, revoked_ms - 1))
+        self.assertTrue(cacheutils.is_signed_token_revoked(self.jti, self.uid, revoked_ms - 1000))
+
+    def test_issued_after_revoke(self):
+        revoked_ms = int(self.REVOKED_AT * 1000)
+        self.assertFalse(cacheutils.is_signed_token_revoked(self.jti, self.uid, revoked_ms + 1))
+
+    def test_issued_same_ms(self):
+        # 同一毫秒内先撤销后签发的token仍然有效
+        self.assertFalse(cacheutils.is_signed_token_revoked(self.jti, self.uid, int(self.REVOKED_AT * 1000)))
+
+    def test_other_user(self):
+        self.assertFalse(cacheutils.is_signed_token_revoked(self.jti, "test-{}".format(uuid.uuid4().hex), 0))
+
+    def test_revoke_jti(self):
+        issued_ms = int(self.REVOKED_AT * 1000) + 1
+        self.assertFalse(cacheutils.is_signed_token_revoked(self.jti, self.uid, issued_ms))
+        cacheutils.revoke_signed_token(self.jti, time.time() + 60)
+        self.assertTrue(cacheutils.is_signed_token_revoked(self.jti, self.uid, issued_ms))
+
+
+class SignedTokenRevokeTimeoutTest(SimpleTestCase):
+    """
+    撤销记录的保留时间取自token的过期时间, 而不是固定的默认有效期
+    """
+
+    def setUp(self):
+        self.uid = "test-{}".format(uuid.uuid4().hex)
+        self.jti = uuid.uuid4().hex
+        self.keys = ["IDAAS:REVOKED-USER-{}".format(self.uid), "IDAAS:REVOKED-{}".format(self.jti),
+                     "IDAAS:SIGNED-EXP-USER-{}".format(self.uid)]
+
+    def tearDown(self):
+        cacheutils.cache.delete_many(self.keys)
+        cacheutils.signed_token_revoked_cache.invalidate(["USER-{}".format(self.uid), self.jti])
+
+    def test_user_latest_exp(self):
+        now = time.time()
+        cacheutils.set_user_signed_token_exp(self.uid, now + 7200)
+        cacheutils.set_user_signed_token_exp(self.uid, now + 600)
+        cacheutils.revoke_user_signed_tokens(self.uid, now + 60)
+        self.assertAlmostEqual(cacheutils.cache.ttl(self.keys[0]), 7200, delta=5)
+
+    def test_user_without_issue_record(self):
+        cacheutils.revoke_user_signed_tokens(self.uid)
+        self.assertAlmostEqual(cacheutils.cache.ttl(self.keys[0]), cacheutils.SIGNED_TOKEN_EXPIRE_SECONDS, delta=5)
+
+    def test_expired(self):
+        cacheutils.revoke_signed_token(self.jti, time.time() - 1)
+        self.assertIsNone(cacheutils.cache.get(self.keys[1]))
+        cacheutils.revoke_signed_token(self.jti, time.time() + 300)
+        self.assertAlmostEqual(cacheutils.cache.ttl(self.keys[1]), 300, delta=5)
+
+
+class CompanyNegativeCacheTest(SimpleTestCase):
+    """
+    只有公司不存在时缓存为空, 数据库异常不写入缓存
+    """
+
+    def setUp(self):
+        self.company_id = "{}".format(uuid.uuid4().int % 10 ** 12)
+        self.counter = company_business.UnknownCompanyCounter()
+        patcher = mock.patch.object(company_business, "unknown_company_counter", self.counter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        company_business.invalidate_company_object(self.company_id)
+
+    def get_company(self, error):
+        with mock.patch.object(company_business.Company, "objects") as objects:
+            objects.get.side_effect = error
+            return company_business.get_company_object(self.company_id, "127.0.0.1")
+
+    def test_db_error_not_cached(self):
+        with self.assertRaises(OperationalError):
+            self.get_company(OperationalError("gone away"))
+        self.assertIsNone(cacheutils.get_company_info(self.company_id))
+        self.assertIsNone(company_business.company_local_cache.get(self.company_id))
+        self.assertEqual(self.counter._pending, {})
+
+    def test_not_found_cached(self):
+        self.assertIsNone(self.get_company(company_business.Company.DoesNotExist()))
+        self.assertEqual(cacheutils.get_company_info(self.company_id), company_business.COMPANY_NOT_FOUND)
+        self.assertEqual(self.counter._pending, {"{}|127.0.0.1".format(self.company_id): 1})
+        # 缓存命中后不再查询数据库
+        self.assertIsNone(self.get_company(OperationalError("gone away")))
+        self.assertEqual(self.counter._pending, {"{}|127.0.0.1".format(self.company_id): 2})
+
+
+class SoftDeleteOrg(CoreModel):
+    name = models.CharField(max_length=16)
+
+    class Meta:
+        app_label = "pandora"
+        managed = False
+
+
+class SoftDeleteDept(CoreModel):
+    org = models.ForeignKey(SoftDeleteOrg, on_delete=models.CASCADE, null=True, related_name="depts")
+
+    class Meta:
+        app_label = "pandora"
+        managed = False
+
+
+class SoftDeleteNote(CoreModel):
+    org = models.ForeignKey(SoftDeleteOrg, on_delete=models.SET_NULL, null=True, related_name="notes")
+
+    class Meta:
+        app_label = "pandora"
+        managed = False
+
+
+class SoftDeleteTag(CoreModel):
+    orgs = models.ManyToManyField(SoftDeleteOrg, related_name="tags")
+
+    class Meta:
+        app_label = "pandora"
+        managed = False
+
+
+class SoftDeleteCollectorTest(TransactionTestCase):
+    """
+    集合式软删除: 级联软删除, SET_NULL置空, 多对多关系清除, 每个模型发送一次post_soft_delete
+    """
+
+    MODELS = (SoftDeleteOrg, SoftDeleteDept, SoftDeleteNote, SoftDeleteTag)
+
+    def setUp(self):
+        # 测试模型不参与迁移, 每个测试单独建表
+        with connection.schema_editor() as schema_editor:
+            for model in self.MODELS:
+                schema_editor.create_model(model)
+        self.org = SoftDeleteOrg.objects.create(name="a")
+        self.other = SoftDeleteOrg.objects.create(name="b")
+        self.depts = [SoftDeleteDept.objects.create(org=self.org) for _ in range(3)]
+        self.other_dept = SoftDeleteDept.objects.create(org=self.other)
+        self.note = SoftDeleteNote.objects.create(org=self.org)
+        self.tag = SoftDeleteTag.objects.create()
+        self.tag.orgs.add(self.org, self.other)
+        self.sent = []
+        post_soft_delete.connect(self.on_soft_delete)
+
+    def tearDown(self):
+        post_soft_delete.disconnect(self.on_soft_delete)
+        with connection.schema_editor() as schema_editor:
+            for model in reversed(self.MODELS):
+                schema_editor.delete_model(model)
+
+    def on_soft_delete(self, sender, rows, **kwargs):
+        self.sent.append((sender, sorted(row["uid"] for row in rows)))
+
+    def test_cascade(self):
+        self.org.delete()
+        self.assertTrue(self.org.is_deleted)
+        self.assertFalse(SoftDeleteOrg.objects.filter(pk=self.org.pk).exists())
+        self.assertTrue(SoftDeleteOrg._base_manager.filter(pk=self.org.pk, is_deleted=True).exists())
+        self.assertEqual(list(SoftDeleteDept.objects.values_list("uid", flat=True)), [self.other_dept.pk])
+        self.assertEqual(SoftDeleteDept._base_manager.filter(is_deleted=True, org=None).count(), 3)
+        self.assertTrue(SoftDeleteOrg.objects.filter(pk=self.other.pk).exists())
+
+    def test_set_null(self):
+        self.org.delete()
+        note = SoftDeleteNote.objects.get(pk=self.note.pk)
+        self.assertIsNone(note.org_id)
+        self.assertFalse(note.is_deleted)
+
+    def test_m2m_cleared(self):
+        self.org.delete()
+        self.assertEqual(list(self.tag.orgs.values_list("uid", flat=True)), [self.other.pk])
+
+    def test_m2m_signal(self):
+        actions = []
+
+        def receiver(sender, action, instance, **kwargs):
+            actions.append((action, instance.pk))
+
+        m2m_changed.connect(receiver, sender=SoftDeleteTag.orgs.through)
+        try:
+            self.org.delete()
+        finally:
+            m2m_changed.disconnect(receiver, sender=SoftDeleteTag.orgs.through)
+        self.assertEqual(actions, [("pre_clear", self.org.pk), ("post_clear", self.org.pk)])
+        self.assertEqual(list(self.tag.orgs.values_list("uid", flat=True)), [self.other.pk])
+
+    def test_signal_per_model(self):
+        self.org.delete()
+        self.assertEqual(self.sent, [
+            (SoftDeleteOrg, [self.org.pk]),
+            (SoftDeleteDept, sorted(dept.pk for dept in self.depts)),
+        ])
+
+    def test_queryset_delete(self):
+        SoftDeleteOrg.objects.all().delete()
+        self.assertFalse(SoftDeleteOrg.objects.exists())
+        self.assertFalse(SoftDeleteDept.objects.exists())
+        self.assertFalse(SoftDeleteTag.orgs.through.objects.exists())
+        self.assertEqual([sender for sender, _ in self.sent], [SoftDeleteOrg, SoftDeleteDept])
+        self.assertEqual(len(self.sent[1][1]), 4)
+
+
+class RefreshOnCommitTest(TestCase):
+    """
+    事务内的表刷新去重后在提交时一次刷新, savepoint回滚不会丢失之后的刷新
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(cache_client, "refresh_tables")
+        self.refresh_tables = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def flushed(self):
+        tables = []
+        for args, _ in self.refresh_tables.call_args_list:
+            tables.extend(args[0])
+        return tables
+
+    def test_coalesce(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                cache_client.refresh_table_on_commit("Menu", "", dp.LEVEL_ALL)
+                cache_client.refresh_table_on_commit("Module", 5)
+            self.refresh_tables.assert_not_called()
+        self.assertEqual(self.refresh_tables.call_count, 1)
+        self.assertEqual(self.flushed(), [("Menu", dp.LEVEL_ALL, ""), ("Module", dp.LEVEL_COMPANY, 5)])
+
+    def test_savepoint_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    cache_client.refresh_table_on_commit("Menu", "", dp.LEVEL_ALL)
+                    raise ValueError()
+            except ValueError:
+                pass
+            cache_client.refresh_table_on_commit("Module", 5)
+        self.assertIn(("Module", dp.LEVEL_COMPANY, 5), self.flushed())
+
+    def test_rollback_not_flushed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    cache_client.refresh_table_on_commit("Menu", "", dp.LEVEL_ALL)
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.refresh_tables.assert_not_called()
+        cache_client.table_refresh_collector.tables.clear()
+
+
+class TokenRevokeTest(TestCase):
+    """
+    退出登录软删除令牌, 审计注销物理删除; 缓存在提交后清理, 删除信号照常发送
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="revoke-{}".format(uuid.uuid4().hex))
+        self.tokens = [Token.objects.create(user=self.user) for _ in range(3)]
+        self.uids = [token.pk for token in self.tokens]
+        for token in self.tokens:
+            cacheutils.set_expire_token(token.key, b"principal")
+        self.sent = []
+        post_soft_delete.connect(self.on_soft_delete, sender=Token)
+        post_delete.connect(self.on_delete, sender=Token)
+
+    def tearDown(self):
+        post_soft_delete.disconnect(self.on_soft_delete, sender=Token)
+        post_delete.disconnect(self.on_delete, sender=Token)
+        cacheutils.delete_expire_tokens([token.key for token in self.tokens])
+
+    def on_soft_delete(self, sender, rows, **kwargs):
+        self.sent.append(("soft", len(rows)))
+
+    def on_delete(self, sender, instance, **kwargs):
+        self.sent.append(("delete", instance.pk))
+
+    def test_soft(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(revoke_tokens(Token.objects.filter(user_id=self.user.pk)), 3)
+            self.assertIsNotNone(cacheutils.get_expire_token(self.tokens[0].key))
+        self.assertFalse(Token.objects.filter(user_id=self.user.pk).exists())
+        # 与原先逐个软删除一致, 可为空的外键同时置空
+        self.assertEqual(Token._base_manager.filter(uid__in=self.uids, is_deleted=True, user=None).count(), 3)
+        self.assertEqual(self.sent, [("soft", 3)])
+        for token in self.tokens:
+            self.assertIsNone(cacheutils.get_expire_token(token.key))
+
+    def test_hard(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(revoke_tokens(Token.objects.filter(uid=self.tokens[0].pk), soft=False), 1)
+        self.assertFalse(Token._base_manager.filter(pk=self.tokens[0].pk).exists())
+        self.assertEqual(Token.objects.filter(user_id=self.user.pk).count(), 2)
+        self.assertEqual(self.sent, [("delete", self.tokens[0].pk)])
+        self.assertIsNone(cacheutils.get_expire_token(self.tokens[0].key))
+        self.assertIsNotNone(cacheutils.get_expire_token(self.tokens[1].key))
+
+    def test_hard_includes_soft_deleted(self):
+        Token.objects.filter(uid=self.tokens[0].pk).delete()
+        deleted = revoke_tokens(Token._base_manager.filter(uid__in=self.uids), soft=False)
+        self.assertEqual(deleted, 3)
+        self.assertFalse(Token._base_manager.filter(uid__in=self.uids).exists())
+
+    def test_empty(self):
+        self.assertEqual(revoke_tokens(Token.objects.none()), 0)
+
+
+class TokenReaperTest(TestCase):
+    """
+    过期清理只删除已离开token缓存的过期令牌, 缓存中滑动续期的令牌保留
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="reap-{}".format(uuid.uuid4().hex))
+        old = timezone.now() - datetime.timedelta(minutes=120)
+        self.expired = [Token.objects.create(user=self.user) for _ in range(3)]
+        self.cached = Token.objects.create(user=self.user)
+        self.deleted = Token.objects.create(user=self.user)
+        self.fresh = Token.objects.create(user=self.user)
+        Token._base_manager.exclude(pk=self.fresh.pk).filter(user=self.user).update(create_time=old)
+        Token.objects.filter(pk=self.deleted.pk).delete()
+        cacheutils.set_expire_token(self.cached.key, b"principal")
+
+    def tearDown(self):
+        cacheutils.delete_expire_tokens([self.cached.key])
+
+    def test_reap(self):
+        uids = [token.pk for token in self.expired + [self.deleted]]
+        with self.captureOnCommitCallbacks(execute=True):
+            # chunk_size=2 同时覆盖分页和跳过缓存中的令牌
+            self.assertEqual(reap_expired_tokens(60, chunk_size=2), 4)
+        self.assertFalse(Token._base_manager.filter(uid__in=uids).exists())
+        self.assertTrue(Token.objects.filter(pk=self.cached.pk).exists())
+        self.assertTrue(Token.objects.filter(pk=self.fresh.pk).exists())
+
+    def test_reap_after_cache_expired(self):
+        cacheutils.delete_expire_tokens([self.cached.key])
+        self.assertEqual(reap_expired_tokens(60), 5)
+        self.assertEqual(list(Token._base_manager.values_list("uid", flat=True)), [self.fresh.pk])
+
+
+class CompanyMiddlewareTest(SimpleTestCase):
+    """
+    公司不存在时request.company为空; 查询故障返回认证失败, 不当作未传公司
+    """
+
+    def setUp(self):
+        self.request = RequestFactory().get("/api/v1/menu/", **{"HTTP_{}".format(settings.COMPANY_HEADER): "123"})
+        self.request.user = None
+        company_middleware.CompanyMiddleware(lambda request: None).process_request(self.request)
+
+    def patch_lookup(self, **kwargs):
+        patcher = mock.patch.object(company_middleware, "get_company_object", **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_lazy(self):
+        lookup = self.patch_lookup(return_value=None)
+        lookup.assert_not_called()
+        self.assertFalse(self.request.company)
+        self.assertTrue(self.request._error_company)
+        lookup.assert_called_once()
+
+    def test_lookup_error(self):
+        self.patch_lookup(side_effect=OperationalError("gone away"))
+        with self.assertRaises(AuthenticationFailed) as context:
+            bool(self.request.company)
+        self.assertEqual(context.exception.detail["code"], AUTHENTICATION_FAILED)
+        self.assertFalse(hasattr(self.request, "_error_company"))
+
+    def test_etag_lookup_error(self):
+        self.patch_lookup(side_effect=OperationalError("gone away"))
+        with mock.patch.object(cache_client, "can_cache", return_value=True):
+            response = ConditionalEtagCacheMiddleware(lambda request: None).process_request(self.request)
+        self.assertEqual(json.loads(response.content)["code"], AUTHENTICATION_FAILED)
+
+
+class AllowPermission(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return True
+
+
+class DenyPermission(permissions.BasePermission):
+    message = "deny"
+    code = "deny_code"
+
+    def has_permission(self, request, view):
+        return False
+
+
+class OtherDenyPermission(permissions.BasePermission):
+    message = "other deny"
+
+    def has_permission(self, request, view):
+        return False
+
+
+class CompilePermissionsTest(SimpleTestCase):
+    """
+    编译后的权限检查与DRF逐个检查的结果, message和code一致
+    """
+
+    CASES = [
+        ([AllowPermission], None),
+        ([AllowPermission, DenyPermission], None),
+        ([permissions.GroupPermission], [[AllowPermission, DenyPermission], [OtherDenyPermission]]),
+        ([permissions.GroupPermission], [[OtherDenyPermission], [AllowPermission, DenyPermission]]),
+        ([permissions.GroupPermission], [[DenyPermission], [AllowPermission]]),
+        ([permissions.GroupPermission], []),
+        ([permissions.And(AllowPermission, permissions.Or(DenyPermission, AllowPermission))], None),
+        ([permissions.Not(AllowPermission), DenyPermission], None),
+        ([AllowPermission, permissions.GroupPermission], [[DenyPermission]]),
+    ]
+
+    @staticmethod
+    def check_uncompiled(permission_classes, view):
+        for permission in permission_classes:
+            permission = permission()
+            if not permission.has_permission(None, view):
+                return False, getattr(permission, "message", None), getattr(permission, "code", None)
+        return True, None, None
+
+    def test_same_result(self):
+        for permission_classes, groups in self.CASES:
+            view = mock.Mock(permission_classes_groups=groups)
+            evaluate = permissions.compile_permissions(permission_classes, groups)
+            self.assertEqual(evaluate(None, view), self.check_uncompiled(permission_classes, view),
+                             (permission_classes, groups))
+
+    def test_group_message(self):
+        groups = [[AllowPermission, DenyPermission]]
+        evaluate = permissions.compile_permissions([permissions.GroupPermission], groups)
+        self.assertEqual(evaluate(None, mock.Mock(permission_classes_groups=groups)), (False, "deny", "deny_code"))
+
+
+class TableLocalCacheTest(SimpleTestCase):
+    """
+    进程内L1表版本缓存: 命中时不读Redis, 本进程刷新和其他worker的失效消息立即生效
+    """
+
+    def setUp(self):
+        self.name = "test_tables_{}".format(uuid.uuid4().hex)
+        self.local_cache = localcache.LocalCache(self.name, timeout=60, broadcast=False)
+        patcher = mock.patch.object(table_cache, "table_local_cache", self.local_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.table = "TEST{}".format(uuid.uuid4().hex).upper()
+        self.tables = [(self.table, dp.LEVEL_ALL, "")]
+        self.key = "{}_{}_".format(self.table, dp.LEVEL_ALL)
+
+    def tearDown(self):
+        localcache._registry.pop(self.name, None)
+        table_cache.cache.delete_many([self.key, table_cache.gen_epoch_key(self.table)])
+
+    def get_version(self):
+        return table_cache.get_tables_last_modify(self.tables)[0]
+
+    def test_local_hit(self):
+        version = self.get_version()
+        table_cache.set_table_last_modify(self.key, 5)
+        self.assertEqual(self.get_version(), version)
+        self.assertGreater(self.local_cache.hits, 0)
+
+    def test_refresh_invalidates(self):
+        self.get_version()
+        table_cache.set_table_last_modify(self.key, 5)
+        table_cache.refresh_table(self.table, "", dp.LEVEL_ALL)
+        self.assertTrue(self.get_version().startswith("6."))
+
+    def test_remote_invalidation(self):
+        self.get_version()
+        table_cache.set_table_last_modify(self.key, 42)
+        localcache._dispatch({"name": self.name, "keys": [self.key]})
+        self.assertTrue(self.get_version().startswith("42."))
+
+
+class TableVersionIncrTest(SimpleTestCase):
+    """
+    表版本为原子INCR计数器: 缺失时以种子初始化, 旧的秒级时间戳直接递增, 同一秒内的多次刷新都会改变ticket
+    """
+
+    def setUp(self):
+        self.table = "TEST{}".format(uuid.uuid4().hex).upper()
+        self.key = "{}_{}_".format(self.table, dp.LEVEL_ALL)
+
+    def tearDown(self):
+        table_cache.cache.delete_many([self.key, table_cache.gen_epoch_key(self.table)])
+        table_cache.table_local_cache.invalidate([self.key])
+
+    def test_seed_missing(self):
+        with mock.patch.object(table_cache, "gen_version_seed", return_value=1000):
+            self.assertEqual(table_cache.incr_tables_last_modify([self.key]), [1001])
+            self.assertEqual(table_cache.incr_tables_last_modify([self.key]), [1002])
+
+    def test_legacy_timestamp(self):
+        table_cache.set_table_last_modify(self.key, 1700000000)
+        self.assertEqual(table_cache.incr_tables_last_modify([self.key]), [1700000001])
+
+    def test_refresh_changes_ticket(self):
+        tables = [(self.table, dp.LEVEL_ALL, "")]
+        tickets = set()
+        for _ in range(3):
+            tickets.add(cache_client.gen_ticket(table_cache.get_tables_last_modify(tables)))
+            table_cache.refresh_table(self.table, "", dp.LEVEL_ALL)
+        self.assertEqual(len(tickets), 3)
+
+
+class TableHashLayoutTest(SimpleTestCase):
+    """
+    hash布局: 同一(level, code)的表版本保存在一个hash中, 读取、初始化和INCR与key布局结果一致
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(table_cache, "TABLE_LAYOUT", table_cache.TABLE_LAYOUT_HASH)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.code = uuid.uuid4().hex
+        self.tables = [("MENU", dp.LEVEL_COMPANY, self.code), ("MODULE", dp.LEVEL_COMPANY, self.code)]
+        self.keys = ["{}_{}_{}".format(table, level, code) for table, level, code in self.tables]
+        self.hash_key = table_cache.cache.make_key("TABLE_VERSIONS:{%s_%s}" % (dp.LEVEL_COMPANY, self.code))
+
+    def tearDown(self):
+        table_cache.get_redis_client().delete(self.hash_key)
+        table_cache.table_local_cache.invalidate(self.keys)
+
+    def test_resolve_and_incr(self):
+        self.assertEqual(table_cache.resolve_tables_last_modify(self.keys, 100), dict.fromkeys(self.keys, 100))
+        self.assertEqual(sorted(table_cache.get_redis_client().hkeys(self.hash_key)), [b"MENU", b"MODULE"])
+        self.assertEqual(table_cache.incr_tables_last_modify(self.keys[:1]), [101])
+        self.assertEqual(table_cache.resolve_tables_last_modify(self.keys, 200), {self.keys[0]: 101, self.keys[1]: 100})
+
+    def test_refresh_changes_ticket(self):
+        before = table_cache.get_tables_last_modify(self.tables)
+        table_cache.refresh_table("Module", self.code)
+        after = table_cache.get_tables_last_modify(self.tables)
+        self.assertEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+
+
+class PermissionBitmapTest(TestCase):
+    """
+    用户在项目下的有效权限位: 多个组OR合并, 授权和成员变化后增量更新, CatalogPermission读取权限位
+    """
+
+    def setUp(self):
+        self.client_id = "bitmap-{}".format(uuid.uuid4().hex)
+        self.user = User.objects.create(username="bitmap-{}".format(uuid.uuid4().hex))
+        self.menu = Menu.objects.create(client_id=self.client_id, alias="m", name="m", code="m")
+        self.module = Module.objects.create(client_id=self.client_id, alias="d", name="d", code="d")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.groups = [CatalogPermissionGroup.objects.create(client_id=self.client_id, name=str(i),
+                                                                 status=CommonStatus.ENABLE) for i in range(2)]
+            for group in self.groups:
+                CatalogPermissionGroupMember.objects.create(group=group, user=self.user)
+            CatalogPermissionGroupMenu.objects.create(group=self.groups[0], menu=self.menu, mode=ActionMode.READ)
+            CatalogPermissionGroupMenu.objects.create(group=self.groups[1], menu=self.menu, mode=ActionMode.WRITE)
+            CatalogPermissionGroupModule.objects.create(group=self.groups[1], module=self.module,
+                                                        mode=ActionMode.READ)
+        self.key = permission_business.cache.make_key(
+            permission_business.gen_bitmap_key(self.user.pk, self.client_id))
+
+    def tearDown(self):
+        permission_business.get_redis_client().delete(self.key)
+
+    def field(self, category, object_id):
+        return permission_business.gen_bitmap_field(category, object_id)
+
+    def test_bitmap(self):
+        self.assertEqual(permission_business.get_permission_bitmap(self.user.pk, self.client_id), {
+            self.field(permission_business.PERMISSION_MENU, self.menu.pk): ActionMode.READ | ActionMode.WRITE,
+            self.field(permission_business.PERMISSION_MODULE, self.module.pk): ActionMode.READ,
+        })
+        self.assertTrue(permission_business.has_permission_mode(
+            self.user.pk, self.client_id, permission_business.PERMISSION_MODULE, self.module.pk, ActionMode.READ))
+        self.assertFalse(permission_business.has_permission_mode(
+            self.user.pk, self.client_id, permission_business.PERMISSION_MODULE, self.module.pk, ActionMode.WRITE))
+
+    def test_incremental(self):
+        permission_business.get_permission_bitmap(self.user.pk, self.client_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            CatalogPermissionGroupMenu.objects.filter(group=self.groups[1]).delete(soft=False)
+        self.assertEqual(permission_business.get_permission_mode(
+            self.user.pk, self.client_id, permission_business.PERMISSION_MENU, self.menu.pk), ActionMode.READ)
+        with self.captureOnCommitCallbacks(execute=True):
+            CatalogPermissionGroupMember.objects.filter(group=self.groups[1]).delete()
+        with mock.patch.object(permission_business, "query_permission_bitmaps") as query:
+            bitmap = permission_business.get_permission_bitmap(self.user.pk, self.client_id)
+            query.assert_not_called()
+        self.assertEqual(bitmap, {self.field(permission_business.PERMISSION_MENU, self.menu.pk): ActionMode.READ})
+
+    def test_catalog_permission(self):
+        view = mock.Mock(catalog_permission=(permission_business.PERMISSION_MENU, "menu_id"),
+                         kwargs={"menu_id": self.menu.pk})
+        headers = {"HTTP_{}".format(settings.APP_HEADER): self.client_id}
+        request = RequestFactory().get("/", **headers)
+        request.user = self.user
+        self.assertTrue(permissions.CatalogPermission().has_permission(request, view))
+        request = RequestFactory().get("/")
+        request.user = self.user
+        self.assertFalse(permissions.CatalogPermission().has_permission(request, view))
+        with self.captureOnCommitCallbacks(execute=True):
+            CatalogPermissionGroupMenu.objects.filter(group=self.groups[0]).delete(soft=False)
+        request = RequestFactory().get("/", **headers)
+        request.user = self.user
+        self.assertFalse(permissions.CatalogPermission().has_permission(request, view))
+        request = RequestFactory().post("/", **headers)
+        request.user = self.user
+        self.assertTrue(permissions.CatalogPermission().has_permission(request, view))
+
+
+class MenuTreeTest(TestCase):
+    """
+    菜单树快照按MPTT区间组装并缓存, 按权限位裁剪后通过菜单接口返回
+    """
+
+    def setUp(self):
+        self.client_id = "menu-{}".format(uuid.uuid4().hex)
+        self.user = User.objects.create(username="menu-{}".format(uuid.uuid4().hex))
+        self.root = Menu.objects.create(client_id=self.client_id, alias="root", name="a", code="root")
+        self.granted = Menu.objects.create(client_id=self.client_id, alias="b", name="b", code="b", parent=self.root)
+        self.hidden = Menu.objects.create(client_id=self.client_id, alias="c", name="c", code="c", parent=self.root)
+        with self.captureOnCommitCallbacks(execute=True):
+            group = CatalogPermissionGroup.objects.create(client_id=self.client_id, name="g",
+                                                          status=CommonStatus.ENABLE)
+            CatalogPermissionGroupMember.objects.create(group=group, user=self.user)
+            CatalogPermissionGroupMenu.objects.create(group=group, menu=self.granted, mode=ActionMode.READ)
+        self.headers = {"HTTP_{}".format(settings.APP_HEADER): self.client_id}
+
+    def tearDown(self):
+        permission_business.get_redis_client().delete(permission_business.cache.make_key(
+            permission_business.gen_bitmap_key(self.user.pk, self.client_id)))
+
+    def test_snapshot(self):
+        tree = menu_business.get_menu_tree(client_id=self.client_id)
+        self.assertEqual([node["uid"] for node in tree], [self.root.pk])
+        self.assertEqual([node["uid"] for node in tree[0]["children"]], [self.granted.pk, self.hidden.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(menu_business.get_menu_tree(client_id=self.client_id), tree)
+
+    def call(self, view, **kwargs):
+        request = RequestFactory().get("/", **self.headers)
+        force_authenticate(request, user=self.user)
+        return json.loads(view.as_view()(request, **kwargs).render().content)
+
+    def test_endpoint(self):
+        data = self.call(PermissionMenuTreeEndpoint)["data"]
+        self.assertEqual([node["uid"] for node in data], [self.root.pk])
+        self.assertEqual([node["uid"] for node in data[0]["children"]], [self.granted.pk])
+        data = self.call(PermissionMenuSubtreeEndpoint, menu_id=self.granted.pk)["data"]
+        self.assertEqual(data["uid"], self.granted.pk)
+        self.assertNotEqual(self.call(PermissionMenuSubtreeEndpoint, menu_id=self.hidden.pk)["code"], 0)
+
+
+class SingleFlightStaleTest(TestCase):
+    """
+    其他worker持有租约时返回旧数据, 旧数据超过max-stale窗口后改为等待并回源
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.code = uuid.uuid4().hex
+
+        @cache_client.dependant_cache({dp.LEVEL_COMPANY: ["company_id"]}, [dp.Node(dp.LEVEL_COMPANY, ["Menu"])])
+        def load_stale(company_id):
+            self.calls.append(company_id)
+            return len(self.calls)
+
+        self.load = load_stale
+        for name, value in (("SINGLE_FLIGHT_ON", True), ("MAX_STALE", 60), ("LEASE_WAIT", 0.01)):
+            patcher = mock.patch.object(cache_client, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_stale_window(self):
+        self.assertEqual(self.load(company_id=self.code), 1)
+        table_cache.refresh_table("Menu", self.code)
+        with mock.patch.object(cache_client, "acquire_cache_lease", return_value=None):
+            self.assertEqual(self.load(company_id=self.code), 1)
+            with mock.patch.object(table_cache.time, "time", return_value=time.time() + 61):
+                self.assertEqual(self.load(company_id=self.code), 2)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_api_body(self):
+        key = "TEST:{}".format(self.code)
+        table_cache.set_api_body(key, "old", [], b"{}")
+        self.assertEqual(table_cache.get_api_body(key, "new", 60), ([], b"{}", False))
+        self.assertIsNone(table_cache.get_api_body(key, "new"))
+        with mock.patch.object(table_cache.time, "time", return_value=time.time() + 61):
+            self.assertIsNone(table_cache.get_api_body(key, "new", 60))
+        # 升级前没有写入时间的条目不作为旧数据返回
+        value = table_cache.msgpack.packb(["old", table_cache.BODY_RAW, [], b"{}"], use_bin_type=True)
+        table_cache.get_redis_client().set(table_cache.cache.make_key("API:{}".format(key)), value)
+        self.assertEqual(table_cache.get_api_body(key, "old"), ([], b"{}", True))
+        self.assertIsNone(table_cache.get_api_body(key, "new", 60))
+
+
+class DependentsItemsTest(SimpleTestCase):
+    """
+    注册的依赖表按level汇总, 用于重置API缓存
+    """
+
+    def setUp(self):
+        self.mapping = dp.Dependents()
+        self.mapping.register(route="/api/<str:version>/menu/", dependents=[
+            dp.Node(dp.LEVEL_ALL, ["Menu"]), dp.Node(dp.LEVEL_COMPANY, ["Module"])])
+        self.mapping.register(route="/api/<str:version>/module/", dependents=[dp.Node(dp.LEVEL_COMPANY, ["Module"])])
+        self.mapping.register(dp.CATEGORY_INNER, func="load", dependents=[dp.Node(dp.LEVEL_COMPANY, ["Company"])])
+
+    def test_all_items(self):
+        self.assertEqual(self.mapping.get_dependants_all_items(), {
+            dp.LEVEL_ALL: ["Menu"], dp.LEVEL_COMPANY: ["Module", "Company"]})
+        self.assertEqual(self.mapping.get_dependent_items(["{}:LOAD".format(dp.CATEGORY_INNER)]), {
+            dp.LEVEL_ALL: [], dp.LEVEL_COMPANY: ["Company"]})
+
+    def test_table_levels(self):
+        # 同一张表在同一level被多次注册时只记录一次, 表变化时每个level只刷新一次
+        self.assertEqual(self.mapping.get_table_levels("Module"), [dp.LEVEL_COMPANY])
+        self.assertEqual(self.mapping.get_table_levels("Menu"), [dp.LEVEL_ALL])
+
+
+class ApiBodyCompressTest(SimpleTestCase):
+    """
+    响应体以msgpack二进制保存, 超过阈值时zlib压缩, 读取时还原响应头和响应体
+    """
+
+    def setUp(self):
+        self.company = uuid.uuid4().hex
+        self.path = "/api/v1/test/?q={}".format(uuid.uuid4().hex)
+        self.key = cache_client.get_api_cache_key(self.company, self.path)
+
+    def tearDown(self):
+        table_cache.get_redis_client().delete(table_cache.cache.make_key("API:{}".format(self.key)))
+
+    def stored_flag(self):
+        value = table_cache.get_redis_client().get(table_cache.cache.make_key("API:{}".format(self.key)))
+        return table_cache.unpack_api_body(value)[1]
+
+    def test_compressed(self):
+        body = json.dumps({"code": 0, "data": ["x" * 10] * 500}).encode()
+        size = cache_client.set_api_cache_data(self.company, self.path, "t1", body,
+                                               [("Content-Type", "application/json"), ("ETag", '"old"')])
+        self.assertLess(size, len(body))
+        self.assertEqual(self.stored_flag(), table_cache.BODY_ZLIB)
+        ret, response = cache_client.get_api_cache_data(self.company, self.path, "t1")
+        self.assertTrue(ret)
+        self.assertEqual(response.content, body)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertFalse(response.has_header("ETag"))
+        self.assertEqual(cache_client.get_api_cache_data(self.company, self.path, "t2"), (False, None))
+
+    def test_small_body_raw(self):
+        cache_client.set_api_cache_data(self.company, self.path, "t1", b'{"code": 0}', [])
+        self.assertEqual(self.stored_flag(), table_cache.BODY_RAW)
+        self.assertEqual(cache_client.get_api_cache_data(self.company, self.path, "t1")[1].content, b'{"code": 0}')
+
+
+class EtagCacheFillTest(SimpleTestCase):
+    """
+    未命中时回填复用请求阶段的ticket, 下一次请求直接返回缓存; 超过大小限制的响应体不回填
+    """
+
+    def setUp(self):
+        name = "fill-{}".format(uuid.uuid4().hex)
+        cache_client.mapping.register(route="/api/<str:version>/{}/".format(name),
+                                      dependents=[dp.Node(dp.LEVEL_ALL, ["Menu"])])
+        self.path = "/api/v1/{}/".format(name)
+        self.body = json.dumps({"code": 0, "data": [1, 2, 3]}).encode()
+        self.middleware = ConditionalEtagCacheMiddleware(lambda request: None)
+
+    def tearDown(self):
+        key = cache_client.get_api_cache_key(None, self.path)
+        table_cache.get_redis_client().delete(table_cache.cache.make_key("API:{}".format(key)))
+
+    def request(self, **headers):
+        request = RequestFactory().get(self.path, **headers)
+        request.user = None
+        request._cached_company_id = None
+        return request
+
+    def fill(self):
+        request = self.request()
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertTrue(request.missing_cache)
+        with mock.patch.object(cache_client, "get_tables_last_modify") as get_tables_last_modify:
+            response = self.middleware.process_response(
+                request, HttpResponse(self.body, content_type="application/json"))
+            get_tables_last_modify.assert_not_called()
+        self.assertEqual(response["ETag"], quote_etag(request.cache_ticket))
+        return response
+
+    def test_fill_and_hit(self):
+        etag = self.fill()["ETag"]
+        response = self.middleware.process_request(self.request())
+        self.assertEqual(response.content, self.body)
+        response = self.middleware.process_request(self.request(HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+
+    def test_body_too_large(self):
+        with mock.patch.object(cache_client, "MAX_BODY_SIZE", len(self.body) - 1):
+            self.fill()
+        self.assertIsNone(self.middleware.process_request(self.request()))
+
+
+class CacheStatsTest(SimpleTestCase):
+    """
+    每个worker的统计增量合并到Redis, 全局统计为各worker之和
+    """
+
+    def setUp(self):
+        cache_stats.reset_global_stats()
+        self.addCleanup(cache_stats.reset_global_stats)
+
+    def test_flush_merges_workers(self):
+        workers = [cache_stats.CacheStats(), cache_stats.CacheStats()]
+        for worker in workers:
+            worker.incr_route("API:/api/<str:version>/menu/", cache_stats.HITS)
+            worker.incr_route("API:/api/<str:version>/menu/", cache_stats.REDIS_TIME, 0.25)
+            worker.incr_tables(["MENU_0_"])
+        workers[0].incr_route("API:/api/<str:version>/menu/", cache_stats.MISSES, 2)
+        for worker in workers:
+            worker.flush()
+        # 已合并的增量不会重复写入
+        workers[0].flush()
+        route = cache_stats.get_global_stats()["routes"]["API:/api/<str:version>/menu/"]
+        self.assertEqual((route[cache_stats.HITS], route[cache_stats.MISSES]), (2, 2))
+        self.assertAlmostEqual(route[cache_stats.REDIS_TIME], 0.5)
+        self.assertEqual(cache_stats.get_global_stats()["tables"], {"MENU_0_": 2})
+        self.assertEqual(workers[0].snapshot()["routes"]["API:/api/<str:version>/menu/"][cache_stats.MISSES], 2)
+
+
+class ResetApiCacheTest(TestCase):
+    """
+    epoch重置一次写入使所有公司的ticket失效; 回退模式按批次刷新每个公司的表版本
+    """
+
+    def setUp(self):
+        self.table = "RESET_{}".format(uuid.uuid4().hex).upper()
+        self.companies = [Company.objects.create(name=str(i), code=str(i)) for i in range(3)]
+
+    def tables(self, company):
+        return [(self.table, dp.LEVEL_COMPANY, company.pk)]
+
+    def tickets(self):
+        return [cache_client.gen_ticket(table_cache.get_tables_last_modify(self.tables(company)))
+                for company in self.companies]
+
+    def test_epoch(self):
+        before = self.tickets()
+        with mock.patch.object(cache_client, "refresh_tables") as refresh_tables:
+            result = cache_client.refresh_all_cache_tables({dp.LEVEL_ALL: [], dp.LEVEL_COMPANY: [self.table]})
+            refresh_tables.assert_not_called()
+        self.assertEqual(result[dp.LEVEL_COMPANY], 1)
+        after = self.tickets()
+        self.assertTrue(all(old != new for old, new in zip(before, after)))
+        table_cache.refresh_epoch()
+        self.assertTrue(all(old != new for old, new in zip(after, self.tickets())))
+
+    def test_pipeline(self):
+        before = self.tickets()
+        with mock.patch.object(cache_client, "RESET_CHUNK_SIZE", 2):
+            result = cache_client.refresh_all_cache_tables({dp.LEVEL_COMPANY: [self.table]}, epoch=False)
+        self.assertEqual(result[dp.LEVEL_COMPANY], Company.objects.count())
+        self.assertTrue(all(old != new for old, new in zip(before, self.tickets())))
+
+
+class DependantCacheManyTest(SimpleTestCase):
+    """
+    批量调用与逐个调用结果一致, 只有未命中或表版本变化的参数回源
+    """
+
+    def setUp(self):
+        self.calls = []
+        # 函数按名称只注册一次, 各测试使用相同的依赖表
+        self.table = "MANY_TABLE"
+        self.kwargs_list = [{"company_id": uuid.uuid4().hex} for _ in range(3)]
+
+        @cache_client.dependant_cache({dp.LEVEL_COMPANY: ["company_id"]}, [dp.Node(dp.LEVEL_COMPANY, [self.table])])
+        def load_many(company_id):
+            self.calls.append(company_id)
+            return company_id.upper()
+
+        self.load = load_many
+
+    def loader(self, kwargs_list):
+        self.calls.append(len(kwargs_list))
+        return [kwargs["company_id"].upper() for kwargs in kwargs_list]
+
+    def test_many(self):
+        expected = [kwargs["company_id"].upper() for kwargs in self.kwargs_list]
+        self.assertEqual(self.load.many(self.kwargs_list, loader=self.loader), expected)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(self.load.many(self.kwargs_list), expected)
+        self.assertEqual(self.load(**self.kwargs_list[1]), expected[1])
+        self.assertEqual(self.calls, [3])
+        table_cache.refresh_table(self.table, self.kwargs_list[2]["company_id"])
+        self.assertEqual(self.load.many(self.kwargs_list), expected)
+        self.assertEqual(self.calls, [3, self.kwargs_list[2]["company_id"]])
+
+    def test_loader_length_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.load.many(self.kwargs_list, loader=lambda kwargs_list: [])
+
+
+class ApiCacheGraphTest(SimpleTestCase):
+    """
+    依赖关系图与统计合并, 未使用、低命中率和每次请求都失效的注册被标记出来
+    """
+
+    def setUp(self):
+        mapping = dp.Dependents()
+        mapping.register(route="/api/<str:version>/menu/", dependents=[dp.Node(dp.LEVEL_ALL, ["Menu"])])
+        mapping.register(route="/api/<str:version>/module/", dependents=[dp.Node(dp.LEVEL_COMPANY, ["Module"])])
+        mapping.register(route="/api/<str:version>/user/", dependents=[dp.Node(dp.LEVEL_COMPANY, ["User"])])
+        mapping.register(dp.CATEGORY_INNER, func="idle", dependents=[dp.Node(dp.LEVEL_ALL, ["Menu"])])
+        metrics = dict.fromkeys(cache_stats.ROUTE_METRICS, 0)
+        global_stats = {
+            "routes": {
+                "/api/<str:version>/menu/": dict(metrics, hits=90, misses=10),
+                "/api/<str:version>/module/": dict(metrics, hits=1, misses=9),
+                "/api/<str:version>/user/": dict(metrics, not_modified=5, misses=5),
+            },
+            "tables": {"MENU": 3, "USER": 20},
+        }
+        for target, name, value in ((api_cache_graph.client, "mapping", mapping),
+                                    (api_cache_graph, "get_global_stats", lambda: global_stats)):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_analyze(self):
+        data = api_cache_graph.analyze_api_cache_graph(min_hit_rate=0.2)
+        rows = {row["key"]: row for row in data["mappings"]}
+        self.assertEqual(rows["API:/api/<str:version>/menu/"]["reasons"], [])
+        self.assertEqual(rows["API:/api/<str:version>/module/"]["reasons"], ["low_hit_rate"])
+        self.assertEqual(rows["API:/api/<str:version>/user/"]["reasons"], ["invalidated_per_request"])
+        self.assertEqual(rows["INNER:IDLE"]["reasons"], ["unused"])
+        self.assertEqual(data["mappings"][-1]["key"], "API:/api/<str:version>/menu/")
+        self.assertEqual(data["tables"]["Menu"]["keys"], ["API:/api/<str:version>/menu/", "INNER:IDLE"])
+        self.assertEqual(data["tables"]["Menu"]["refresh"], 3)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("api_cache_graph", "--dead", "--json", stdout=out)
+        keys = [row["key"] for row in json.loads(out.getvalue())["mappings"]]
+        self.assertNotIn("API:/api/<str:version>/menu/", keys)
+        self.assertEqual(len(keys), 3)
+
+
+class RouteCompanyTablesTest(SimpleTestCase):
+    """
+    依赖表按(路由模板, 公司)缓存, 同一路由的不同URL共用一个条目
+    """
+
+    def setUp(self):
+        self.mapping = dp.Dependents()
+        self.mapping.register(route="/api/<str:version>/user/<int:pk>/", dependents=[
+            dp.Node(dp.LEVEL_ALL, ["Menu"]), dp.Node(dp.LEVEL_COMPANY, ["User"])])
+
+    def test_keyed_on_route(self):
+        for pk in range(20):
+            self.assertEqual(self.mapping.get_api_company_dependent_tables(7, "/api/v1/user/{}/".format(pk)),
+                             (("Menu", dp.LEVEL_ALL, ""), ("User", dp.LEVEL_COMPANY, 7)))
+        info = self.mapping.get_cache_info()["route_company_tables"]
+        self.assertEqual((info["currsize"], info["misses"]), (1, 1))
+        self.mapping.get_api_company_dependent_tables(8, "/api/v1/user/1/")
+        self.assertEqual(self.mapping.get_cache_info()["route_company_tables"]["currsize"], 2)
+        self.assertEqual(self.mapping.get_api_company_dependent_tables(7, "/api/v1/group/"), ())
+
+
+class TokenLocalCacheTest(SimpleTestCase):
+    """
+    已验证token在本worker内缓存, 删除时同时失效; 滑动续期在间隔内只EXPIRE一次
+    """
+
+    def setUp(self):
+        self.key = uuid.uuid4().hex
+        local_cache = localcache.LocalCache("test_expire_token", broadcast=False)
+        touch_cache = localcache.LocalCache("test_expire_token_touch", broadcast=False)
+        for name, value in (("token_local_cache", local_cache), ("token_touch_cache", touch_cache)):
+            patcher = mock.patch.object(cacheutils, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(cacheutils.delete_expire_token, self.key)
+
+    def test_local_hit(self):
+        cacheutils.set_expire_token(self.key, b"principal")
+        with mock.patch.object(cacheutils.cache, "get") as cache_get:
+            self.assertEqual(cacheutils.get_expire_token(self.key), b"principal")
+            cache_get.assert_not_called()
+        cacheutils.delete_expire_token(self.key)
+        self.assertIsNone(cacheutils.get_expire_token(self.key))
+
+    def test_touch_throttled(self):
+        cacheutils.cache.set("IDAAS:TOKEN-{}".format(self.key), b"principal", 60)
+        with mock.patch.object(cacheutils.cache, "expire") as cache_expire:
+            self.assertTrue(cacheutils.touch_expire_token(self.key))
+            self.assertFalse(cacheutils.touch_expire_token(self.key))
+            cache_expire.assert_called_once_with("IDAAS:TOKEN-{}".format(self.key), cacheutils.TOKEN_TIMEOUT)
+
+
+class CachedPrincipalTest(TestCase):
+    """
+    token缓存保存msgpack精简身份, 命中缓存时认证不查询数据库; 旧格式的缓存值视为未命中
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="principal-{}".format(uuid.uuid4().hex), is_staff=True)
+        self.token = Token.objects.create(user=self.user)
+        self.addCleanup(cacheutils.delete_expire_token, self.token.key)
+
+    def test_authenticate_from_cache(self):
+        authentication = ExpiringTokenAuthentication()
+        authentication.authenticate_credentials(self.token.key)
+        with self.assertNumQueries(0):
+            user, token = authentication.authenticate_credentials(self.token.key)
+            self.assertEqual((user.pk, user.is_staff, user.is_authenticated), (self.user.pk, True, True))
+            self.assertEqual((token.pk, token.key, token.user_id), (self.token.pk, self.token.key, self.user.pk))
+        # 缓存中没有的字段从数据库加载
+        self.assertEqual(user.username, self.user.username)
+
+    def test_unpack_old_format(self):
+        packed = CachedPrincipal.from_token(self.token).pack()
+        self.assertEqual(CachedPrincipal.unpack(packed).token_key, self.token.key)
+        self.assertIsNone(CachedPrincipal.unpack(pickle.dumps((self.user.pk, self.token.key))))
+        self.assertIsNone(CachedPrincipal.unpack(None))
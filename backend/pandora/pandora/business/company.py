@@ -1,24 +1,157 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import time
+import threading
 from pandora.models import Company
-from pandora.utils.cacheutils import get_company_info, set_company_info
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from pandora.utils.cacheutils import get_company_info, set_company_info, delete_company_info
+from pandora.utils.localcache import LocalCache
 import logging
 
 LOG = logging.getLogger(__name__)
 
+# 进程内公司缓存, Company保存/删除时通过pub_sub广播失效; 缓存的实例在请求间共享, 只能读取
+company_local_cache = LocalCache("company",
+                                 maxsize=getattr(settings, "COMPANY_CACHE_LOCAL_MAXSIZE", 4096),
+                                 timeout=getattr(settings, "COMPANY_CACHE_LOCAL_TIMEOUT", 60),
+                                 enabled=getattr(settings, "COMPANY_CACHE_LOCAL_ON", False))
+
+
+# 不存在的公司id短时间缓存为空, 避免错误的公司头每次都查询数据库
+COMPANY_NOT_FOUND = "__COMPANY_NOT_FOUND__"
+COMPANY_NEGATIVE_TIMEOUT = getattr(settings, "COMPANY_NEGATIVE_TIMEOUT", 30)
+UNKNOWN_COMPANY_STATS_KEY = "X-COMPANY-UNKNOWN"
+UNKNOWN_COMPANY_STATS_TIMEOUT = 3600 * 24
+UNKNOWN_COMPANY_STATS_MAX_FIELDS = getattr(settings, "UNKNOWN_COMPANY_STATS_MAX_FIELDS", 1000)
+UNKNOWN_COMPANY_FLUSH_INTERVAL = getattr(settings, "UNKNOWN_COMPANY_FLUSH_INTERVAL", 10)
+UNKNOWN_COMPANY_OTHER = "__other__|"
+UNKNOWN_COMPANY_INVALID = "__invalid__"
+
 
 def get_companies():
     return Company.objects.all()
 
 
-def get_company_object(company_id):
+def get_company_object(company_id, client=None):
+    """
+    client: 请求来源(如IP), 用于统计发送不存在公司id的客户端
+    只有公司不存在或id格式错误时短时间缓存为空, 其他异常直接抛出
+    """
+    company = company_local_cache.get(company_id)
+    if company:
+        return _check_company(company, company_id, client)
     company = get_company_info(company_id)
-    if not company:
+    if company:
+        company_local_cache.set(company_id, company,
+                                COMPANY_NEGATIVE_TIMEOUT if company == COMPANY_NOT_FOUND else None)
+        return _check_company(company, company_id, client)
+    try:
+        company = Company.objects.get(uid=company_id)
+        set_company_info(company_id, company)
+        company_local_cache.set(company_id, company)
+        return company
+    except Company.DoesNotExist as e:
+        LOG.error("Get company {} Failed, {}".format(company_id, e))
+    except (ValueError, ValidationError) as e:
+        LOG.error("Bad company {} Params, {}".format(company_id, e))
+    except Exception as e:
+        # 数据库故障或重复数据不能当作不存在缓存, 否则有效公司会在所有worker中短时间不可用
+        LOG.error("Get company {} Error, {}".format(company_id, e))
+        raise
+    set_company_info(company_id, COMPANY_NOT_FOUND, COMPANY_NEGATIVE_TIMEOUT)
+    company_local_cache.set(company_id, COMPANY_NOT_FOUND, COMPANY_NEGATIVE_TIMEOUT)
+    return _check_company(COMPANY_NOT_FOUND, company_id, client)
+
+
+def _check_company(company, company_id, client):
+    if company != COMPANY_NOT_FOUND:
+        return company
+    incr_unknown_company(company_id, client)
+    return None
+
+
+class UnknownCompanyCounter(object):
+    """
+    不存在公司id的请求计数, 进程内聚合后定期合并到Redis, 与缓存统计的方式一致
+    公司id和客户端都来自请求, 字段数在进程内和Redis中都有上限, 超出的计入__other__
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+
+    @staticmethod
+    def gen_field(company_id, client):
+        company_id = "{}".format(company_id)
+        if not company_id.isdigit() or len(company_id) > 20:
+            company_id = UNKNOWN_COMPANY_INVALID
+        return "{}|{}".format(company_id, "{}".format(client or "")[:64])
+
+    def incr(self, company_id, client=None):
+        field = self.gen_field(company_id, client)
+        with self._lock:
+            if field not in self._pending and len(self._pending) >= UNKNOWN_COMPANY_STATS_MAX_FIELDS:
+                field = UNKNOWN_COMPANY_OTHER
+            self._pending[field] = self._pending.get(field, 0) + 1
+            due = time.monotonic() - self._last_flush >= UNKNOWN_COMPANY_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
         try:
-            company = Company.objects.get(uid=company_id)
-            set_company_info(company_id, company)
-        except (company.DoesNotExist, company.MultipleObjectsReturned) as e:
-            LOG.error("Get company {} Failed, {}".format(company_id, e))
+            redis = cache.client.get_client(write=True)
+            key = cache.make_key(UNKNOWN_COMPANY_STATS_KEY)
+            fields = list(pending.keys())
+            pipe = redis.pipeline(transaction=False)
+            pipe.hlen(key)
+            for field in fields:
+                pipe.hexists(key, field)
+            size, *exists = pipe.execute()
+            pipe = redis.pipeline(transaction=False)
+            for field, exist in zip(fields, exists):
+                count = pending[field]
+                if not exist:
+                    if size >= UNKNOWN_COMPANY_STATS_MAX_FIELDS:
+                        field = UNKNOWN_COMPANY_OTHER
+                    else:
+                        size += 1
+                pipe.hincrby(key, field, count)
+            pipe.expire(key, UNKNOWN_COMPANY_STATS_TIMEOUT)
+            pipe.execute()
         except Exception as e:
-            LOG.error("Bad company {} Params, {}".format(company_id, e))
-    return company
+            LOG.error("flush unknown company stats failed, {}".format(e))
+
+
+unknown_company_counter = UnknownCompanyCounter()
+
+
+def incr_unknown_company(company_id, client=None):
+    unknown_company_counter.incr(company_id, client)
+
+
+def get_unknown_company_stats():
+    """
+    最近一天内请求不存在公司id的次数, 按(公司id, 客户端)统计
+    """
+    unknown_company_counter.flush()
+    redis = cache.client.get_client(write=True)
+    result = []
+    for field, value in redis.hgetall(cache.make_key(UNKNOWN_COMPANY_STATS_KEY)).items():
+        company_id, client = field.decode().rsplit("|", 1)
+        result.append({"company_id": company_id, "client": client, "count": int(value)})
+    result.sort(key=lambda item: item["count"], reverse=True)
+    return result
+
+
+def invalidate_company_object(company_id):
+    company_id = "{}".format(company_id)
+    delete_company_info(company_id)
+    company_local_cache.invalidate([company_id])
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.conf import settings
+from pandora.models import Menu
+from pandora.models.collection import ActionMode
+from pandora.core.cachedependency.client import dependant_cache
+from pandora.core.cachedependency.dependents import Node, LEVEL_ALL
+from pandora.business.permission import PERMISSION_MENU, gen_bitmap_field, get_permission_bitmap
+import logging
+
+LOG = logging.getLogger(__name__)
+
+MENU_TREE_FIELDS = ("uid", "parent_id", "client_id", "alias", "name", "code", "terminals", "description",
+                    "category", "status", "mode", "sort_number", "level")
+MENU_TREE_TIMEOUT = getattr(settings, "MENU_TREE_CACHE_TIMEOUT", 3600 * 4)
+
+
+def assemble_menu_tree(nodes):
+    """
+    nodes按(tree_id, lft)有序, 利用MPTT区间一次线性遍历组装嵌套结构
+    栈中保存尚未闭合的祖先节点, 当前节点的lft超过栈顶的rght时栈顶子树结束
+    """
+    roots = []
+    stack = []
+    for node in nodes:
+        tree_id, lft, rght = node.pop("tree_id"), node.pop("lft"), node.pop("rght")
+        while stack and (stack[-1][0] != tree_id or stack[-1][1] < lft):
+            stack.pop()
+        if stack:
+            stack[-1][2].setdefault("children", []).append(node)
+        else:
+            roots.append(node)
+        if rght - lft > 1:
+            stack.append((tree_id, rght, node))
+    return roots
+
+
+@dependant_cache({LEVEL_ALL: []}, [Node(LEVEL_ALL, ["Menu"])], timeout=MENU_TREE_TIMEOUT)
+def get_menu_tree(client_id):
+    """
+    项目的完整菜单树快照, 一次按lft排序的values()查询; Menu变化时通过依赖表版本失效
+    """
+    nodes = Menu.objects.filter(client_id=client_id).order_by("tree_id", "lft").values(
+        "tree_id", "lft", "rght", *MENU_TREE_FIELDS)
+    return assemble_menu_tree(list(nodes))
+
+
+def filter_menu_tree(tree, bitmap, mode=ActionMode.READ):
+    """
+    按权限位图裁剪菜单树, 不访问数据库; 有权限的节点或有可见子节点的节点保留
+    """
+    result = []
+    for node in tree:
+        children = filter_menu_tree(node.get("children", ()), bitmap, mode)
+        granted = bitmap.get(gen_bitmap_field(PERMISSION_MENU, node["uid"]), 0) & mode == mode
+        if not granted and not children:
+            continue
+        item = {key: value for key, value in node.items() if key != "children"}
+        if children:
+            item["children"] = children
+        result.append(item)
+    return result
+
+
+def get_user_menu_tree(user_id, client_id, mode=ActionMode.READ):
+    return filter_menu_tree(get_menu_tree(client_id=client_id), get_permission_bitmap(user_id, client_id), mode)
+
+
+def find_menu_node(tree, menu_id):
+    for node in tree:
+        if node["uid"] == menu_id:
+            return node
+        found = find_menu_node(node.get("children", ()), menu_id)
+        if found is not None:
+            return found
+    return None
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import CharField, Value
+from pandora.models import CatalogPermissionGroup, CatalogPermissionGroupMember
+from pandora.models import CatalogPermissionGroupMenu, CatalogPermissionGroupModule
+from pandora.models.collection import CommonStatus
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# 用户在某个项目下的有效权限: Redis hash, 字段为"menu:<uid>"/"module:<uid>", 值为ActionMode位
+PERMISSION_MENU = "menu"
+PERMISSION_MODULE = "module"
+BITMAP_BUILT_FIELD = "__built__"
+BITMAP_TIMEOUT = getattr(settings, "PERMISSION_BITMAP_TIMEOUT", 3600 * 24)
+
+
+def gen_bitmap_key(user_id, client_id):
+    return "PERMISSION_BITMAP:{}:{}".format(user_id, client_id)
+
+
+def gen_bitmap_field(category, object_id):
+    return "{}:{}".format(category, object_id)
+
+
+def get_redis_client():
+    return cache.client.get_client(write=True)
+
+
+def _member_grants(user_ids, client_id, category, object_ids=None):
+    """
+    用户所在的启用状态的组对菜单/模块的授权, 返回(user_id, 类别, 对象id, mode)的queryset
+    """
+    grant_model, object_field = CatalogPermissionGroupMenu, "menu_id"
+    if category == PERMISSION_MODULE:
+        grant_model, object_field = CatalogPermissionGroupModule, "module_id"
+    queryset = grant_model.objects.filter(group__client_id=client_id, group__status=CommonStatus.ENABLE,
+                                          group__is_deleted=False,
+                                          group__catalog_member_user__user_id__in=user_ids,
+                                          group__catalog_member_user__is_deleted=False)
+    if object_ids is not None:
+        queryset = queryset.filter(**{"{}__in".format(object_field): object_ids})
+    return queryset.annotate(
+        category=Value(category, output_field=CharField())
+    ).values_list("group__catalog_member_user__user_id", "category", object_field, "mode").order_by()
+
+
+def query_permission_bitmaps(user_ids, client_id):
+    """
+    一次UNION查询取出全部授权, 按(用户, 对象)OR合并ActionMode位
+    """
+    bitmaps = {user_id: {} for user_id in user_ids}
+    queryset = _member_grants(user_ids, client_id, PERMISSION_MENU).union(
+        _member_grants(user_ids, client_id, PERMISSION_MODULE), all=True)
+    for user_id, category, object_id, mode in queryset:
+        if object_id is None:
+            continue
+        bitmap = bitmaps.setdefault(user_id, {})
+        field = gen_bitmap_field(category, object_id)
+        bitmap[field] = bitmap.get(field, 0) | mode
+    return bitmaps
+
+
+def _write_bitmaps(client_id, bitmaps):
+    pipe = get_redis_client().pipeline(transaction=True)
+    for user_id, bitmap in bitmaps.items():
+        key = cache.make_key(gen_bitmap_key(user_id, client_id))
+        pipe.delete(key)
+        pipe.hset(key, mapping=dict(bitmap, **{BITMAP_BUILT_FIELD: 1}))
+        pipe.expire(key, BITMAP_TIMEOUT)
+    pipe.execute()
+
+
+def build_permission_bitmaps(user_ids, client_id):
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    if not user_ids:
+        return {}
+    bitmaps = query_permission_bitmaps(user_ids, client_id)
+    _write_bitmaps(client_id, bitmaps)
+    return bitmaps
+
+
+def get_permission_bitmap(user_id, client_id):
+    """
+    返回{"menu:<uid>": mode, "module:<uid>": mode}, 未缓存时构建
+    """
+    user_id = int(user_id)
+    data = get_redis_client().hgetall(cache.make_key(gen_bitmap_key(user_id, client_id)))
+    if not data:
+        return build_permission_bitmaps([user_id], client_id)[user_id]
+    return {field.decode(): int(value) for field, value in data.items() if field.decode() != BITMAP_BUILT_FIELD}
+
+
+def get_permission_mode(user_id, client_id, category, object_id):
+    """
+    单个菜单/模块的有效权限位, 一次HMGET
+    """
+    user_id, field = int(user_id), gen_bitmap_field(category, object_id)
+    value, built = get_redis_client().hmget(cache.make_key(gen_bitmap_key(user_id, client_id)),
+                                             [field, BITMAP_BUILT_FIELD])
+    if built is None:
+        return build_permission_bitmaps([user_id], client_id)[user_id].get(field, 0)
+    return int(value) if value is not None else 0
+
+
+def has_permission_mode(user_id, client_id, category, object_id, mode):
+    return get_permission_mode(user_id, client_id, category, object_id) & mode == mode
+
+
+def get_group_member_ids(group_id):
+    return list(CatalogPermissionGroupMember.objects.filter(group_id=group_id).values_list("user_id", flat=True))
+
+
+def get_group_client_id(group_id):
+    # 包含已软删除的组, 组删除时仍需要找到项目
+    return CatalogPermissionGroup._base_manager.filter(uid=group_id).values_list("client_id", flat=True).first()
+
+
+def refresh_members_permission_bitmaps(members):
+    """
+    批量组成员变化: members为[(user_id, group_id)], 按项目合并后每个项目构建一次
+    """
+    members = [(user_id, group_id) for user_id, group_id in members if user_id is not None and group_id is not None]
+    if not members:
+        return
+    clients = dict(CatalogPermissionGroup._base_manager.filter(
+        uid__in={group_id for _, group_id in members}).values_list("uid", "client_id"))
+    client_users = {}
+    for user_id, group_id in members:
+        client_id = clients.get(group_id)
+        if client_id is not None:
+            client_users.setdefault(client_id, []).append(user_id)
+    for client_id, user_ids in client_users.items():
+        build_permission_bitmaps(user_ids, client_id)
+
+
+def refresh_groups_permission_bitmaps(group_ids):
+    """
+    组本身变化(启用/禁用/删除): 重建组内全部成员的权限
+    """
+    refresh_members_permission_bitmaps(CatalogPermissionGroupMember.objects.filter(
+        group_id__in=set(group_ids)).values_list("user_id", "group_id"))
+
+
+def refresh_client_group_permission_bitmaps(group_id, client_id):
+    """
+    按指定项目重建组成员的权限, 用于组修改项目后刷新原项目
+    """
+    if client_id is None:
+        return
+    build_permission_bitmaps(get_group_member_ids(group_id), client_id)
+
+
+def refresh_group_permission_bitmaps(group_id):
+    refresh_groups_permission_bitmaps([group_id])
+
+
+def refresh_grant_permission_bitmaps(group_id, category, object_id):
+    """
+    组授权变化: 只重新计算组内成员在这一个菜单/模块上的权限位, 其他字段不变
+    未构建过的用户跳过, 下次访问时完整构建
+    """
+    client_id = get_group_client_id(group_id)
+    if client_id is None or object_id is None:
+        return
+    user_ids = get_group_member_ids(group_id)
+    if not user_ids:
+        return
+    modes = dict.fromkeys(user_ids, 0)
+    for user_id, _, _, mode in _member_grants(user_ids, client_id, category, [object_id]):
+        modes[user_id] = modes.get(user_id, 0) | mode
+    field = gen_bitmap_field(category, object_id)
+    redis = get_redis_client()
+    keys = [cache.make_key(gen_bitmap_key(user_id, client_id)) for user_id in user_ids]
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.hexists(key, BITMAP_BUILT_FIELD)
+    built = pipe.execute()
+    pipe = redis.pipeline(transaction=False)
+    for user_id, key, exists in zip(user_ids, keys, built):
+        if not exists:
+            continue
+        if modes[user_id]:
+            pipe.hset(key, field, modes[user_id])
+        else:
+            pipe.hdel(key, field)
+    pipe.execute()
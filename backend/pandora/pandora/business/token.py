@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import datetime
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from pandora.models import Token
+from pandora.utils.cacheutils import delete_expire_tokens, get_cached_token_keys
+import logging
+
+LOG = logging.getLogger(__name__)
+
+REVOKE_CHUNK_SIZE = 1000
+
+
+def revoke_tokens(tokens, soft=True):
+    """
+    批量注销令牌, 返回注销数量
+    soft=True: 软删除, 与原先退出登录一致; soft=False: 物理删除(含已软删除的记录), 用于审计注销和过期清理
+    每批一次删除, 表依赖刷新和对象缓存清理由post_soft_delete/post_delete信号处理, 与其他写入路径一致
+    """
+    items = list(tokens.values_list("uid", "key"))
+    if not items:
+        return 0
+    uids = [uid for uid, _ in items]
+    keys = [key for _, key in items]
+    deleted = 0
+    with transaction.atomic():
+        for i in range(0, len(uids), REVOKE_CHUNK_SIZE):
+            chunk = uids[i:i + REVOKE_CHUNK_SIZE]
+            if soft:
+                _, count = Token.objects.filter(uid__in=chunk).delete()
+                deleted += count
+            else:
+                _, rows = Token._base_manager.filter(uid__in=chunk).delete()
+                deleted += rows.get(Token._meta.label, 0)
+        # 提交后再删除缓存, 避免并发请求在提交前把旧token重新写入缓存
+        transaction.on_commit(lambda: delete_expire_tokens(keys))
+    LOG.info("revoke {} tokens".format(deleted))
+    return deleted
+
+
+def reap_expired_tokens(expire_minutes, chunk_size=REVOKE_CHUNK_SIZE):
+    """
+    按(create_time, uid)顺序分批物理删除过期(含已软删除)的token, 返回删除数量
+    仍在token缓存中的token由滑动续期保持登录(与原先请求路径的行为一致), 跳过不删除, 离开缓存后的下一轮再删除
+    """
+    cutoff = timezone.now() - datetime.timedelta(minutes=expire_minutes)
+    total = 0
+    last = None
+    while True:
+        queryset = Token._base_manager.filter(create_time__lt=cutoff)
+        if last:
+            queryset = queryset.filter(Q(create_time__gt=last[0]) | Q(create_time=last[0], uid__gt=last[1]))
+        items = list(queryset.order_by("create_time", "uid").values_list("create_time", "uid", "key")[:chunk_size])
+        if not items:
+            break
+        cached = get_cached_token_keys([key for _, _, key in items])
+        uids = [uid for _, uid, key in items if key not in cached]
+        if uids:
+            total += revoke_tokens(Token._base_manager.filter(uid__in=uids), soft=False)
+        if len(items) < chunk_size:
+            break
+        last = items[-1][:2]
+    return total
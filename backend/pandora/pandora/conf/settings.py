@@ -146,6 +146,22 @@ REST_FRAMEWORK = {
     "VERSION_PARAM": "version"
 }
 REST_FRAMEWORK_TOKEN_EXPIRE_MINUTES = 60
+TOKEN_CACHE_LOCAL_ON = os.getenv("TOKEN_CACHE_LOCAL", "FALSE").lower() in ("on", "true", "y", "yes")
+TOKEN_CACHE_LOCAL_TIMEOUT = 30
+TOKEN_CACHE_LOCAL_MAXSIZE = 10000
+TOKEN_CACHE_TOUCH_INTERVAL = 60
+TOKEN_REAPER_CHUNK_SIZE = 1000
+COMPANY_CACHE_LOCAL_ON = os.getenv("COMPANY_CACHE_LOCAL", "FALSE").lower() in ("on", "true", "y", "yes")
+COMPANY_CACHE_LOCAL_TIMEOUT = 60
+COMPANY_CACHE_LOCAL_MAXSIZE = 4096
+COMPANY_NEGATIVE_TIMEOUT = 30
+UNKNOWN_COMPANY_STATS_MAX_FIELDS = 1000
+PERMISSION_BITMAP_TIMEOUT = 3600 * 24
+MENU_TREE_CACHE_TIMEOUT = 3600 * 4
+SOFT_DELETE_CHUNK_SIZE = 1000
+SIGNED_TOKEN_ON = os.getenv("SIGNED_TOKEN", "FALSE").lower() in ("on", "true", "y", "yes")
+SIGNED_TOKEN_SECRET = os.getenv("SIGNED_TOKEN_SECRET", SECRET_KEY)
+SIGNED_TOKEN_EXPIRE_MINUTES = REST_FRAMEWORK_TOKEN_EXPIRE_MINUTES
 AUTHENTICATION_BACKENDS = [
     "django.contrib.auth.backends.ModelBackend",
     # "django_cas_ng.backends.CASBackend",
@@ -172,6 +188,22 @@ DATABASES = {
 
 API_CACHE_ON = os.getenv("API_CACHE", "TRUE").lower() in ("on", "true", "y", "yes")
 API_CACHE_REDIS = "api_cache"
+API_CACHE_SCRIPT_ON = os.getenv("API_CACHE_SCRIPT", "TRUE").lower() in ("on", "true", "y", "yes")
+# key: 每个表每个公司一个key; hash: 每个(level, code)一个hash, HMGET读取, 减少key数量; 一次读取跨多个slot, 不是Cluster安全的
+API_CACHE_TABLE_LAYOUT = os.getenv("API_CACHE_TABLE_LAYOUT", "key").lower()
+API_CACHE_LOCAL_ON = os.getenv("API_CACHE_LOCAL", "FALSE").lower() in ("on", "true", "y", "yes")
+API_CACHE_LOCAL_TIMEOUT = int(os.getenv("API_CACHE_LOCAL_TIMEOUT", 5))
+API_CACHE_LOCAL_MAXSIZE = 65536
+API_CACHE_COMPRESS_MIN_SIZE = 1024
+API_CACHE_COMPRESS_LEVEL = 6
+API_CACHE_SINGLE_FLIGHT_ON = os.getenv("API_CACHE_SINGLE_FLIGHT", "FALSE").lower() in ("on", "true", "y", "yes")
+API_CACHE_LEASE_TIMEOUT = int(os.getenv("API_CACHE_LEASE_TIMEOUT", 5))
+API_CACHE_LEASE_WAIT = 0.5
+# 回源期间其他worker可返回的旧数据的最大年龄(秒)
+API_CACHE_MAX_STALE = int(os.getenv("API_CACHE_MAX_STALE", 60))
+API_CACHE_MAX_BODY_SIZE = 1024 * 1024
+API_CACHE_STATS_ON = True
+API_CACHE_STATS_FLUSH_INTERVAL = 10
 # The cache backends to use.
 CACHES = {
     "pandora_key_value": {
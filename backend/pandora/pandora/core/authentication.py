@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import datetime
+import time
+import uuid
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.utils import timezone
@@ -8,10 +10,60 @@ from django.utils import timezone
 from rest_framework.authentication import BaseAuthentication, get_authorization_header
 from pandora.models import Token
 from pandora.core.exceptions import AuthenticationFailed
-from pandora.utils.cacheutils import get_expire_token, set_expire_token, delete_expire_token
+from pandora.core.user import CachedPrincipal
+from pandora.utils.cacheutils import get_expire_token, set_expire_token, touch_expire_token
+from pandora.utils.cacheutils import is_signed_token_revoked, set_user_signed_token_exp
+from pandora.utils.encryp import encode_json_to_token, decode_json_from_token
+import logging
+
+LOG = logging.getLogger(__name__)
 
 EXPIRE_MINUTES = getattr(settings, 'REST_FRAMEWORK_TOKEN_EXPIRE_MINUTES', 60)
 
+# 签名token: 在进程内验证签名和过期时间, 只查询Redis中的撤销记录; 数据库token继续用于旧客户端
+SIGNED_TOKEN_ON = getattr(settings, "SIGNED_TOKEN_ON", False)
+SIGNED_TOKEN_SECRET = getattr(settings, "SIGNED_TOKEN_SECRET", settings.SECRET_KEY)
+SIGNED_TOKEN_EXPIRE_MINUTES = getattr(settings, "SIGNED_TOKEN_EXPIRE_MINUTES", EXPIRE_MINUTES)
+
+
+def is_signed_token(key):
+    # JWS compact格式为header.payload.signature, 数据库token为hex字符串
+    return key.count(".") == 2
+
+
+def encode_signed_token(user, expire_minutes=SIGNED_TOKEN_EXPIRE_MINUTES):
+    # iat_ms为毫秒签发时间, 与撤销记录比较, 避免同一秒内先撤销后签发的token被误判为已撤销
+    now_ms = int(time.time() * 1000)
+    now = now_ms // 1000
+    payload = {
+        "jti": uuid.uuid4().hex,
+        "uid": user.uid,
+        "role": user.role,
+        "is_staff": user.is_staff,
+        "is_superuser": user.is_superuser,
+        "iat": now,
+        "iat_ms": now_ms,
+        "exp": now + expire_minutes * 60,
+    }
+    set_user_signed_token_exp(user.uid, payload["exp"])
+    return encode_json_to_token(payload, salt=SIGNED_TOKEN_SECRET)
+
+
+def decode_signed_token(key):
+    """
+    验证签名和过期时间, 失败时抛出AuthenticationFailed
+    """
+    try:
+        payload = decode_json_from_token(key, salt=SIGNED_TOKEN_SECRET)
+    except Exception as e:
+        LOG.info("invalid signed token, {}".format(e))
+        raise AuthenticationFailed(_("认证令牌无效。"))
+    if not isinstance(payload, dict) or not payload.get("jti") or not payload.get("uid"):
+        raise AuthenticationFailed(_("认证令牌无效。"))
+    if payload.get("exp", 0) <= time.time():
+        raise AuthenticationFailed(_("登录已超时，请重新登录"))
+    return payload
+
 
 class SessionAuthentication(BaseAuthentication):
     """
@@ -78,11 +130,14 @@ class TokenAuthentication(BaseAuthentication):
 
 class ExpiringTokenAuthentication(TokenAuthentication):
     def authenticate_credentials(self, key):
+        if SIGNED_TOKEN_ON and is_signed_token(key):
+            return self.authenticate_signed_credentials(key)
+
         # Search token in cache
-        cache_user_token = get_expire_token(key)
-        if cache_user_token:
-            set_expire_token(key, cache_user_token)
-            return cache_user_token
+        principal = CachedPrincipal.unpack(get_expire_token(key))
+        if principal:
+            touch_expire_token(key)
+            return principal.get_user(), principal.get_token()
 
         model = self.model
         try:
@@ -96,13 +151,23 @@ class ExpiringTokenAuthentication(TokenAuthentication):
         time_now = timezone.now()
 
         if token.create_time < time_now - datetime.timedelta(minutes=EXPIRE_MINUTES):
-            delete_expire_token(key)
-            token.delete(soft=False)
+            # 过期token由定时任务reap_expired_tokens批量删除, 请求路径上不写库
             raise AuthenticationFailed(_("登录已超时，请重新登录"))
 
         if token:
             # Cache token
-            set_expire_token(key, (token.user, token))
+            set_expire_token(key, CachedPrincipal.from_token(token).pack())
         return token.user, token
 
-
+    def authenticate_signed_credentials(self, key):
+        """
+        签名token不查询数据库, request.auth为token的payload
+        """
+        payload = decode_signed_token(key)
+        issued_ms = payload.get("iat_ms", payload.get("iat", 0) * 1000)
+        if is_signed_token_revoked(payload["jti"], payload["uid"], issued_ms):
+            raise AuthenticationFailed(_("登录已失效, 请重新登录"))
+        principal = CachedPrincipal(payload["uid"], payload.get("role"), True, payload.get("is_staff", False),
+                                    payload.get("is_superuser", False), None,
+                                    payload["jti"], payload.get("iat", 0), None)
+        return principal.get_user(), payload
@@ -4,39 +4,144 @@ from django.utils.cache import caches
 from django.utils import timezone
 from .dependents import LEVEL_COMPANY, LEVEL_ALL, REFRESH_EVERY_GET_ITEMS
 from django.conf import settings
+from pandora.utils.localcache import LocalCache
+from .stats import stats
+import msgpack
 import random
+import time
+import zlib
 
 import logging
 
 LOG = logging.getLogger(__name__)
 cache = caches[settings.API_CACHE_REDIS]
 
+TABLES_SCRIPT_ON = getattr(settings, "API_CACHE_SCRIPT_ON", True)
 
-def gen_seed_value():
-    return int(timezone.now().timestamp())
+# 进程内L1表版本缓存, 写操作通过pub_sub广播失效, timeout为最大陈旧秒数
+table_local_cache = LocalCache("api_cache_tables",
+                               maxsize=getattr(settings, "API_CACHE_LOCAL_MAXSIZE", 65536),
+                               timeout=getattr(settings, "API_CACHE_LOCAL_TIMEOUT", 5),
+                               enabled=getattr(settings, "API_CACHE_LOCAL_ON", False))
+
+# 一次往返取出全部表版本, 缺失的表以ARGV[1]初始化
+TABLES_LAST_MODIFY_SCRIPT = """
+local result = {}
+for i, key in ipairs(KEYS) do
+    local value = redis.call("GET", key)
+    if not value then
+        redis.call("SET", key, ARGV[1])
+        value = ARGV[1]
+    end
+    result[i] = value
+end
+return result
+"""
+
+_tables_last_modify_script = None
+
+# 表版本存储布局: key为每个表每个公司一个字符串key; hash为每个(level, code)一个hash, 字段为表名
+# hash布局用于减少key数量和内存, 只使用单key命令(HMGET/HSETNX/HINCRBY), 放在非事务pipeline中发出
+# 一个ticket同时读取LEVEL_ALL的hash、公司的hash和epoch hash, 它们位于不同slot, 读取不是单slot操作, 不能视为Cluster安全
+# key名中的花括号保留只是为了兼容已有数据
+# 两种布局的数据互不迁移, 切换布局后需执行reset_api_cache
+TABLE_LAYOUT_KEY = "key"
+TABLE_LAYOUT_HASH = "hash"
+TABLE_LAYOUT = getattr(settings, "API_CACHE_TABLE_LAYOUT", TABLE_LAYOUT_KEY)
+EPOCH_PREFIX = "TABLE_EPOCH:"
+
+# API缓存直接保存渲染好的响应体, 超过阈值时zlib压缩
+API_COMPRESS_MIN_SIZE = getattr(settings, "API_CACHE_COMPRESS_MIN_SIZE", 1024)
+API_COMPRESS_LEVEL = getattr(settings, "API_CACHE_COMPRESS_LEVEL", 6)
+BODY_RAW = 0
+BODY_ZLIB = 1
+
+
+def gen_version_seed():
+    """
+    表版本计数器的初始值(微秒), 保证重新初始化的计数器大于旧的秒级时间戳
+    """
+    return int(timezone.now().timestamp() * 1000000)
 
 
 def gen_day_seed_value():
     return int(timezone.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
 
 
+def get_table_hash_location(key):
+    """
+    逻辑key到(hash key, 字段)的映射
+    表版本"TABLE_LEVEL_CODE" -> ("TABLE_VERSIONS:{LEVEL_CODE}", "TABLE"), epoch统一放在一个hash中
+    """
+    if key.startswith(EPOCH_PREFIX):
+        return "{TABLE_EPOCH}", key[len(EPOCH_PREFIX):]
+    table, level, code = key.rsplit("_", 2)
+    return "TABLE_VERSIONS:{%s_%s}" % (level, code), table
+
+
+def group_table_hash_keys(keys):
+    groups = {}
+    for key in keys:
+        hash_key, field = get_table_hash_location(key)
+        groups.setdefault(hash_key, []).append((key, field))
+    return groups
+
+
 def set_table_last_modify(key, value, timeout=None):
+    if TABLE_LAYOUT == TABLE_LAYOUT_HASH:
+        hash_key, field = get_table_hash_location(key)
+        get_redis_client().hset(cache.make_key(hash_key), field, cache.client.encode(value))
+        return value
     cache.set(key, value, timeout)
     return value
 
 
+def incr_tables_last_modify(keys):
+    """
+    原子INCR表版本计数器, 一个pipeline完成
+    不存在的计数器先以微秒种子初始化; 旧的秒级时间戳同样是整数, 直接在其基础上递增
+    """
+    if not keys:
+        return []
+    seed = gen_version_seed()
+    redis = get_redis_client()
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        if TABLE_LAYOUT == TABLE_LAYOUT_HASH:
+            hash_key, field = get_table_hash_location(key)
+            redis_key = cache.make_key(hash_key)
+            pipe.hsetnx(redis_key, field, seed)
+            pipe.hincrby(redis_key, field, 1)
+        else:
+            redis_key = cache.make_key(key)
+            pipe.set(redis_key, seed, nx=True)
+            pipe.incr(redis_key)
+    items = pipe.execute(raise_on_error=False)[1::2]
+    result = []
+    for key, item in zip(keys, items):
+        if isinstance(item, Exception):
+            LOG.error("incr table {} failed, {}".format(key, item))
+            item = set_table_last_modify(key, gen_version_seed())
+        result.append(item)
+    return result
+
+
 def refresh_table(table, code, level=LEVEL_COMPANY):
     key = "{}_{}_{}".format(table.upper(), level, code)
-    value = gen_seed_value()
-    return set_table_last_modify(key, value)
+    value, = incr_tables_last_modify([key])
+    table_local_cache.invalidate([key])
+    stats.incr_tables([table.upper()])
+    # 只写不读的进程(celery/写接口)也需要把刷新计数合并到Redis
+    stats.maybe_flush()
+    return value
 
 
 def refresh_tables(tables):
     keys = ["{}_{}_{}".format(table[0].upper(), table[1], table[2]) for table in tables]
-    value = gen_seed_value()
-    returns = []
-    for key in keys:
-        returns.append(set_table_last_modify(key, value))
+    returns = incr_tables_last_modify(keys)
+    table_local_cache.invalidate(keys)
+    stats.incr_tables([table[0].upper() for table in tables])
+    stats.maybe_flush()
     return returns
 
 
@@ -50,36 +155,162 @@ def get_instant_table_data(tables):
     return data
 
 
-def get_tables_last_modify(tables):
-    keys = ["{}_{}_{}".format(table[0].upper(), table[1], table[2]) for table in tables]
-    instant_table_data = get_instant_table_data(tables)
+def get_redis_client():
+    return cache.client.get_client(write=True)
+
+
+def _get_tables_last_modify_script():
+    global _tables_last_modify_script
+    if _tables_last_modify_script is None:
+        _tables_last_modify_script = get_redis_client().register_script(TABLES_LAST_MODIFY_SCRIPT)
+    return _tables_last_modify_script
+
+
+def _resolve_by_script(keys, value):
+    """
+    Lua脚本: 一次往返完成读取和缺失初始化
+    """
+    redis_keys = [cache.make_key(key) for key in keys]
+    items = _get_tables_last_modify_script()(keys=redis_keys, args=[value], client=get_redis_client())
+    return {key: cache.client.decode(item) for key, item in zip(keys, items)}
+
+
+def _resolve_by_pipeline(keys, value):
+    """
+    MGET读取, 缺失的表在一个pipeline里SET NX后再读回, 最多两次往返
+    """
     data = cache.get_many(keys)
-    LOG.debug(keys)
-    result = []
-    for key in keys:
-        value = gen_seed_value()
-        if key in instant_table_data:
-            result.append(str(instant_table_data[key]))
-            continue
-        if key not in data:
-            item = cache.get(key)
-            if not item:
-                set_table_last_modify(key, value)
-                result.append(str(value))
+    missing = [key for key in keys if key not in data]
+    if missing:
+        redis = get_redis_client()
+        pipe = redis.pipeline(transaction=False)
+        for key in missing:
+            pipe.set(cache.make_key(key), cache.client.encode(value), nx=True)
+        for key in missing:
+            pipe.get(cache.make_key(key))
+        items = pipe.execute()[len(missing):]
+        for key, item in zip(missing, items):
+            data[key] = cache.client.decode(item) if item is not None else value
+    return data
+
+
+def _resolve_by_hash(keys, value):
+    """
+    hash布局: 每个hash一次HMGET, 在一个pipeline里发出; 缺失的字段HSETNX后再读回
+    """
+    groups = group_table_hash_keys(keys)
+    redis = get_redis_client()
+    pipe = redis.pipeline(transaction=False)
+    for hash_key, items in groups.items():
+        pipe.hmget(cache.make_key(hash_key), [field for _, field in items])
+    data = {}
+    missing = []
+    for (hash_key, items), values in zip(groups.items(), pipe.execute()):
+        for (key, field), item in zip(items, values):
+            if item is None:
+                missing.append((key, hash_key, field))
             else:
-                result.append(str(item))
-                data[key] = item
-        else:
-            result.append(str(data[key]))
+                data[key] = cache.client.decode(item)
+    if missing:
+        pipe = redis.pipeline(transaction=False)
+        for _, hash_key, field in missing:
+            pipe.hsetnx(cache.make_key(hash_key), field, cache.client.encode(value))
+        for _, hash_key, field in missing:
+            pipe.hget(cache.make_key(hash_key), field)
+        items = pipe.execute()[len(missing):]
+        for (key, _, _), item in zip(missing, items):
+            data[key] = cache.client.decode(item) if item is not None else value
+    return data
 
-    LOG.debug(result)
-    return result
+
+def resolve_tables_last_modify(keys, value):
+    if not keys:
+        return {}
+    if TABLE_LAYOUT == TABLE_LAYOUT_HASH:
+        return _resolve_by_hash(keys, value)
+    if TABLES_SCRIPT_ON:
+        try:
+            return _resolve_by_script(keys, value)
+        except Exception as e:
+            LOG.error("resolve tables by script failed, {}".format(e))
+    return _resolve_by_pipeline(keys, value)
+
+
+def gen_epoch_key(table=None):
+    return "{}{}".format(EPOCH_PREFIX, table.upper() if table else "GLOBAL")
+
+
+def refresh_epoch(tables=None):
+    """
+    递增epoch使相关的全部ticket失效, 一次写入代替逐个公司刷新表版本
+    tables为空时递增全局epoch
+    """
+    if tables:
+        keys = [gen_epoch_key(table) for table in tables]
+    else:
+        keys = [gen_epoch_key()]
+    returns = incr_tables_last_modify(keys)
+    table_local_cache.invalidate(keys)
+    return returns
+
+
+def get_tables_last_modify(tables):
+    """
+    每个表的值为"版本.表epoch", 末尾追加全局epoch; 表版本和epoch在同一次往返中读取
+    """
+    return get_many_tables_last_modify([tables])[0]
+
+
+def get_many_tables_last_modify(tables_list):
+    """
+    批量版本: 多组表合并去重后一次往返读取, 按组返回与get_tables_last_modify相同的结果
+    """
+    global_epoch_key = gen_epoch_key()
+    groups = []
+    instant_table_data = {}
+    redis_keys = []
+    for tables in tables_list:
+        keys = ["{}_{}_{}".format(table[0].upper(), table[1], table[2]) for table in tables]
+        epoch_keys = [gen_epoch_key(table[0]) for table in tables]
+        instant_table_data.update(get_instant_table_data(tables))
+        groups.append((keys, epoch_keys))
+        redis_keys += [key for key in keys if key not in instant_table_data]
+        redis_keys += [epoch_key for key, epoch_key in zip(keys, epoch_keys) if key not in instant_table_data]
+    LOG.debug(redis_keys)
+    redis_keys = list(dict.fromkeys(redis_keys + [global_epoch_key]))
+    data = table_local_cache.get_many(redis_keys)
+    missing = [key for key in redis_keys if key not in data]
+    if missing:
+        values = resolve_tables_last_modify(missing, gen_version_seed())
+        table_local_cache.set_many(values)
+        data.update(values)
+    results = []
+    for keys, epoch_keys in groups:
+        result = []
+        for key, epoch_key in zip(keys, epoch_keys):
+            if key in instant_table_data:
+                result.append(str(instant_table_data[key]))
+            else:
+                result.append("{}.{}".format(data[key], data[epoch_key]))
+        result.append(str(data[global_epoch_key]))
+        results.append(result)
+
+    LOG.debug(results)
+    return results
+
+
+def can_serve_stale(filled_at, max_stale):
+    """
+    旧数据自写入起不超过max_stale秒时才允许返回; 没有写入时间的旧条目不返回
+    """
+    return bool(max_stale) and filled_at is not None and time.time() - filled_at <= max_stale
 
 
 def _cache_set(key, data, ticket, timeout=3600 * 4):
     value = {
         "data": data,
-        "ticket": ticket
+        "ticket": ticket,
+        "time": int(time.time())
     }
     if isinstance(timeout, int):
         timeout = random.randint(timeout, timeout << 1)
@@ -87,14 +318,54 @@ def _cache_set(key, data, ticket, timeout=3600 * 4):
     return value
 
 
-def set_api_data(key, data, ticket, timeout=3600 * 4):
+def pack_api_body(ticket, headers, body):
+    flag = BODY_RAW
+    if len(body) >= API_COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(body, API_COMPRESS_LEVEL)
+        if len(compressed) < len(body):
+            flag, body = BODY_ZLIB, compressed
+    return msgpack.packb([ticket, flag, headers, body, int(time.time())], use_bin_type=True)
+
+
+def unpack_api_body(value):
+    # 兼容升级前没有写入时间的条目
+    ticket, flag, headers, body, *rest = msgpack.unpackb(value, raw=False)
+    return ticket, flag, headers, body, rest[0] if rest else None
+
+
+def set_api_body(key, ticket, headers, body, timeout=3600 * 4):
+    """
+    以msgpack二进制保存(ticket, headers, body), 不经过django-redis的pickle
+    返回写入Redis的字节数
+    """
     key = "API:{}".format(key)
-    return _cache_set(key, data, ticket, timeout)
+    value = pack_api_body(ticket, headers, body)
+    if isinstance(timeout, int):
+        timeout = random.randint(timeout, timeout << 1)
+    get_redis_client().set(cache.make_key(key), value, ex=timeout)
+    return len(value)
 
 
-def get_api_data(key):
+def get_api_body(key, ticket, max_stale=0):
+    """
+    返回(headers, body, fresh); ticket不一致且旧数据超过max_stale秒时返回None; 先比对ticket再解压
+    """
     key = "API:{}".format(key)
-    return cache.get(key)
+    value = get_redis_client().get(cache.make_key(key))
+    if not value:
+        return None
+    try:
+        old_ticket, flag, headers, body, filled_at = unpack_api_body(value)
+    except Exception as e:
+        LOG.info("bad api cache {}, {}".format(key, e))
+        return None
+    LOG.debug("ticket get: {}".format(old_ticket))
+    fresh = old_ticket == ticket
+    if not fresh and not can_serve_stale(filled_at, max_stale):
+        return None
+    if flag == BODY_ZLIB:
+        body = zlib.decompress(body)
+    return headers, body, fresh
 
 
 def set_cache_data(key, data, ticket, timeout=3600 * 4):
@@ -103,3 +374,30 @@ def set_cache_data(key, data, ticket, timeout=3600 * 4):
 
 def get_cache_data(key):
     return cache.get(key)
+
+
+def get_many_cache_data(keys):
+    """
+    一次MGET读取多个条目, 返回{key: value}, 不存在的key不在结果中
+    """
+    if not keys:
+        return {}
+    return cache.get_many(keys)
+
+
+def set_many_cache_data(items, timeout=3600 * 4):
+    """
+    items: [(key, data, ticket)], 一个pipeline写入, 每个key仍使用随机过期时间
+    """
+    if not items:
+        return
+    pipe = get_redis_client().pipeline(transaction=False)
+    for key, data, ticket in items:
+        value = {
+            "data": data,
+            "ticket": ticket,
+            "time": int(time.time())
+        }
+        key_timeout = random.randint(timeout, timeout << 1) if isinstance(timeout, int) else timeout
+        cache.set(key, value, key_timeout, client=pipe)
+    pipe.execute()
@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import functools
+import threading
+import time
 from importlib import import_module
 from django.conf import settings
-from .cache import get_api_data, get_tables_last_modify, set_api_data, refresh_table
-from .cache import set_cache_data, get_cache_data
-from .ticket import gen_key, check_ticket, gen_ticket, make_params_key
+from django.db import transaction
+from django.http import HttpResponse
+from .cache import get_api_body, get_tables_last_modify, set_api_body, refresh_table, refresh_tables
+from .cache import set_cache_data, get_cache_data, refresh_epoch, can_serve_stale
+from .cache import get_many_tables_last_modify, get_many_cache_data, set_many_cache_data
+from .ticket import gen_key, gen_ticket, make_args_key
 from .dependents import LEVEL_COMPANY, LEVEL_ALL
 from .dependents import LEVEL_SET
 from .dependents import CATEGORY_INNER
-from pandora.core.response import APIResponse
+from . import stats as stats_keys
+from .stats import stats
 from pandora.models import Company
+from pandora.utils.lock import acquire_lease, release_lease
 
 dependency = import_module(settings.CACHE_DEPENDENCY_MAPPING)
 mapping = dependency.mapping
@@ -21,32 +28,102 @@ LOG = logging.getLogger(__name__)
 
 METHOD_ACTIONS = ["GET", ]
 
+SKIP_CACHE_HEADERS = ["etag", "content-length"]
 
-def refresh_all_cache_tables(tables):
+# single-flight: 同一ticket只允许一个worker回源, 其他worker返回旧数据或短暂等待
+SINGLE_FLIGHT_ON = getattr(settings, "API_CACHE_SINGLE_FLIGHT_ON", False)
+LEASE_TIMEOUT = getattr(settings, "API_CACHE_LEASE_TIMEOUT", 5)
+# stale-while-revalidate窗口: 旧数据自写入起超过该秒数后不再返回, 改为等待回源
+MAX_STALE = getattr(settings, "API_CACHE_MAX_STALE", 60) if SINGLE_FLIGHT_ON else 0
+LEASE_WAIT = getattr(settings, "API_CACHE_LEASE_WAIT", 0.5)
+LEASE_POLL_INTERVAL = 0.05
+
+# 超过该大小的响应体不写入Redis
+MAX_BODY_SIZE = getattr(settings, "API_CACHE_MAX_BODY_SIZE", 1024 * 1024)
+
+
+RESET_CHUNK_SIZE = 1000
+
+
+def refresh_all_cache_tables(tables, epoch=True):
+    """
+    epoch=True: 每个表递增一次epoch, 一个pipeline完成, 与公司数量无关
+    epoch=False: 流式读取公司uid, 按批次pipeline刷新表版本
+    """
     result = dict.fromkeys(LEVEL_SET, 0)
-    for level, tables in tables.items():
+    if epoch:
+        all_tables = []
+        for level, level_tables in tables.items():
+            all_tables.extend(level_tables)
+            result[level] += len(level_tables)
+        if all_tables:
+            refresh_epoch(list(dict.fromkeys(all_tables)))
+        return result
+
+    for level, level_tables in tables.items():
+        if not level_tables:
+            continue
         if level == LEVEL_COMPANY:
-            companys = Company.objects.all()
-            for table in tables:
-                for company in companys:
-                    refresh_table(table, company.uid, level)
-                    result[level] += 1
+            chunk = []
+            company_ids = Company.objects.values_list("uid", flat=True).iterator(chunk_size=RESET_CHUNK_SIZE)
+            for company_id in company_ids:
+                chunk.extend([table, level, company_id] for table in level_tables)
+                if len(chunk) >= RESET_CHUNK_SIZE:
+                    refresh_tables(chunk)
+                    result[level] += len(chunk)
+                    chunk = []
+            if chunk:
+                refresh_tables(chunk)
+                result[level] += len(chunk)
 
         elif level == LEVEL_ALL:
-            for table in tables:
-                refresh_table(table, "", level)
-                result[level] += 1
+            refresh_tables([[table, level, ""] for table in level_tables])
+            result[level] += len(level_tables)
 
     return result
 
 
+class TableRefreshCollector(threading.local):
+    """
+    事务内收集需要刷新的(table, level, code), 按数据库别名去重, 在on_commit时一次pipeline刷新
+    每次收集都注册一个回调, 第一个执行的回调刷新全部, 其余为空操作;
+    savepoint回滚只会丢弃其中注册的回调, 之前注册的回调仍然负责刷新, 不依赖Django的内部回调列表
+    整个事务回滚时回调全部丢弃, 已收集的表留到该连接下次提交时一并刷新, 只会多刷新, 不会漏刷新
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def add(self, using, table, level, code):
+        self.tables.setdefault(using, {})[(table, level, code)] = None
+        transaction.on_commit(functools.partial(self.flush, using), using=using)
+
+    def flush(self, using):
+        tables = list(self.tables.pop(using, {}).keys())
+        if not tables:
+            return
+        LOG.debug("Flush Tables {}".format(tables))
+        refresh_tables(tables)
+
+
+table_refresh_collector = TableRefreshCollector()
+
+
+def refresh_table_on_commit(table, code, level=LEVEL_COMPANY, using=None):
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        refresh_table(table, code, level)
+        return
+    table_refresh_collector.add(connection.alias, table, level, code)
+
+
 def refresh_table_dependency(table, instance):
     levels = mapping.get_table_levels(table)
     for level in levels:
         if level == LEVEL_COMPANY:
             refresh_company_instance_cache_table(table, instance)
         elif level == LEVEL_ALL:
-            refresh_table(table, "", level)
+            refresh_table_on_commit(table, "", level)
 
 
 def refresh_company_cache_table(table, company_id):
@@ -54,7 +131,7 @@ def refresh_company_cache_table(table, company_id):
         LOG.debug("Table {}-{}".format(table, company_id))
     else:
         LOG.debug("Cache Table {}-{}".format(table, company_id))
-        refresh_table(table, company_id)
+        refresh_table_on_commit(table, company_id)
 
 
 def refresh_all_cache_table(table):
@@ -62,7 +139,7 @@ def refresh_all_cache_table(table):
         LOG.debug("All Table {}".format(table))
     else:
         LOG.debug("Cache ALL Table {}".format(table))
-        refresh_table(table, code="", level=LEVEL_ALL)
+        refresh_table_on_commit(table, code="", level=LEVEL_ALL)
 
 
 def refresh_company_instance_cache_table(table, instance):
@@ -72,24 +149,58 @@ def refresh_company_instance_cache_table(table, instance):
         company_id = instance.company_id
     LOG.debug("Cache Company Table {}-{}".format(table, company_id))
     if company_id:
-        refresh_table(table, code=company_id, level=LEVEL_COMPANY)
+        refresh_table_on_commit(table, code=company_id, level=LEVEL_COMPANY)
+
+
+def acquire_cache_lease(key, ticket):
+    return acquire_lease("{}:{}".format(key, ticket), expire=LEASE_TIMEOUT)
+
 
+def release_cache_lease(lease):
+    release_lease(lease)
 
-def get_api_cache_data(company, path, ticket):
-    key = "API:{}".format(gen_key([path, company]))
+
+def wait_cache_data(fetch):
+    """
+    其他worker持有租约时短暂轮询, 直到回填完成或超过LEASE_WAIT
+    """
+    deadline = time.monotonic() + LEASE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LEASE_POLL_INTERVAL)
+        ret, result = fetch()
+        if ret:
+            return ret, result
+    return False, None
+
+
+def get_api_cache_key(company, path):
+    return "API:{}".format(gen_key([path, company]))
+
+
+def get_api_cache_data(company, path, ticket, max_stale=0):
+    """
+    命中返回(True, response); ticket不一致时返回不超过max_stale秒的(False, 旧response)
+    """
+    key = get_api_cache_key(company, path)
     LOG.debug("key: {}".format(key))
     LOG.debug("company: {}".format(company))
-    data = get_api_data(key)
+    data = get_api_body(key, ticket, max_stale)
     if not data:
         return False, None
 
-    old_ticket = data.get("ticket", None)
-    result = data.get("data", None)
-    LOG.debug("ticket get: {}".format(old_ticket))
-    if ticket != old_ticket:
-        return False, None
-    response = APIResponse(data=result.get("result"), headers=result.get("headers"))
-    return True, response.json_render()
+    headers, body, fresh = data
+    response = HttpResponse(body)
+    for name, value in headers:
+        response[name] = value
+    return fresh, response
+
+
+def acquire_api_cache_lease(company, path, ticket):
+    return acquire_cache_lease(get_api_cache_key(company, path), ticket)
+
+
+def wait_api_cache_data(company, path, ticket):
+    return wait_cache_data(lambda: get_api_cache_data(company, path, ticket))
 
 
 def can_cache(company, user, path, method):
@@ -105,16 +216,16 @@ def can_cache(company, user, path, method):
     return True
 
 
-def set_api_cache_data(company, path, ticket, result, headers):
-    key = "API:{}".format(gen_key([path, company]))
+def set_api_cache_data(company, path, ticket, content, headers):
+    key = get_api_cache_key(company, path)
     LOG.debug("company: {}".format(company))
     LOG.debug("key: {}".format(key))
-    data = {
-        "headers": headers,
-        "result": result
-    }
+    if len(content) > MAX_BODY_SIZE:
+        LOG.info("skip cache {}, body size {}".format(key, len(content)))
+        return 0
+    headers = [[name, value] for name, value in headers if name.lower() not in SKIP_CACHE_HEADERS]
     LOG.info("ticket set: {}".format(ticket))
-    set_api_data(key, data, ticket)
+    return set_api_body(key, ticket, headers, content)
 
 
 def format_final_tables(tables, code_map):
@@ -125,80 +236,172 @@ def format_final_tables(tables, code_map):
     return data_tables
 
 
-def _get_common_cache_data(key, data_tables):
+def _get_common_cache_data(key, ticket, max_stale=0):
     data = get_cache_data(key)
     if not data:
         return False, None
 
-    ticket = data.get("ticket", None)
+    old_ticket = data.get("ticket", None)
     info = data.get("data", None)
-    LOG.info("ticket get: {}".format(ticket))
-
-    values = get_tables_last_modify(data_tables)
+    LOG.info("ticket get: {}".format(old_ticket))
 
-    if not check_ticket(ticket, values):
-        return False, None
+    if old_ticket != ticket:
+        return False, info if can_serve_stale(data.get("time"), max_stale) else None
     return True, info
 
 
-def _set_common_cache_data(key, data, data_tables):
-    values = get_tables_last_modify(data_tables)
-    ticket = gen_ticket(values)
+def _set_common_cache_data(key, data, ticket, timeout=3600 * 4):
+    # ticket在回源之前计算, 回源期间发生的写入只会导致下次未命中, 不会把旧数据挂到新ticket上
     LOG.info("ticket set: {}".format(ticket))
-    set_cache_data(key, data, ticket)
-
-
-def _dependant_cache_wrapper(_func, key_map, category, dependents):
+    set_cache_data(key, data, ticket, timeout)
+
+
+def _make_code_map(key_map, kwargs):
+    """
+    按key_map从kwargs取各级别的编码, 缺少必需参数时返回None(不走缓存)
+    """
+    code_map = {}
+    for level, code_names in key_map.items():
+        code_list = []
+        for code_name in code_names:
+            code_value = kwargs.get(code_name)
+            if not code_value:
+                if level != LEVEL_ALL:
+                    return None
+                code_value = ""
+            code_list.append("{}".format(code_value))
+        if not code_list:
+            if level != LEVEL_ALL:
+                return None
+            # 全局级别的表不需要编码, 与refresh_table_on_commit(table, "", LEVEL_ALL)一致
+            code_list.append("")
+        code_map[level] = gen_key(code_list)
+    return code_map
+
+
+def _dependant_cache_wrapper(_func, key_map, category, dependents, timeout, negative_timeout):
     func_name = "{}.{}".format(_func.__module__, _func.__name__).upper()
     mapping.register(category, func=func_name, dependents=dependents, raise_exception=False)
+    stats_name = "{}:{}".format(category, func_name)
 
     def wrapper(*args, **kwargs):
         tables = mapping.get_general_dependent_tables(func_name, category)
-        code_map = {}
-        for level, code_names in key_map.items():
-            code_list = []
-            for code_name in code_names:
-                code_value = kwargs.get(code_name)
-                if not code_value:
-                    if level != LEVEL_ALL:
-                        return _func(*args, **kwargs)
-                    code_value = ""
-                code_list.append("{}".format(code_value))
-            if not code_list:
-                return _func(*args, **kwargs)
-            code_map[level] = gen_key(code_list)
-
+        code_map = _make_code_map(key_map, kwargs)
         if not code_map:
             return _func(*args, **kwargs)
 
-        key_list = ()
-        if args:
-            key_list += str(args),
-        key_list += "##",
-        if kwargs:
-            key_list += str(kwargs),
-
-        key = "{}:{}".format(category, gen_key((func_name, make_params_key(key_list))))
+        key = "{}:{}".format(category, gen_key((func_name, make_args_key(args, kwargs))))
         data_tables = format_final_tables(tables, code_map)
-        ret, result = _get_common_cache_data(key, data_tables)
-        if not ret:
-            LOG.info("miss {} cache: {}".format(func_name, key))
-            try:
-                result = _func(*args, **kwargs)
-                if result:
-                    _set_common_cache_data(key, result, data_tables)
-            except Exception as e:
-                LOG.error(e)
-        else:
+        ticket = gen_ticket(get_tables_last_modify(data_tables))
+        ret, result = _get_common_cache_data(key, ticket, MAX_STALE)
+        if ret:
             LOG.info("hit {} cache: {}".format(func_name, key))
+            stats.incr_route(stats_name, stats_keys.HITS)
+            return result
+
+        lease = None
+        if SINGLE_FLIGHT_ON:
+            stale, result = result, None
+            lease = acquire_cache_lease(key, ticket)
+            if not lease:
+                if stale is not None:
+                    LOG.info("stale {} cache: {}".format(func_name, key))
+                    stats.incr_route(stats_name, stats_keys.STALE)
+                    return stale
+                ret, result = wait_cache_data(lambda: _get_common_cache_data(key, ticket))
+                if ret:
+                    LOG.info("hit {} cache after wait: {}".format(func_name, key))
+                    stats.incr_route(stats_name, stats_keys.HITS)
+                    return result
+
+        LOG.info("miss {} cache: {}".format(func_name, key))
+        stats.incr_route(stats_name, stats_keys.MISSES)
+        try:
+            result = _func(*args, **kwargs)
+            if result:
+                _set_common_cache_data(key, result, ticket, timeout)
+                stats.incr_route(stats_name, stats_keys.FILLS)
+            elif negative_timeout:
+                # 空结果使用独立的较短过期时间缓存
+                _set_common_cache_data(key, result, ticket, negative_timeout)
+                stats.incr_route(stats_name, stats_keys.FILLS)
+        finally:
+            if lease:
+                release_cache_lease(lease)
+            stats.maybe_flush()
         return result
 
+    def many(kwargs_list, loader=None):
+        """
+        批量调用, 返回与kwargs_list顺序一致的结果列表
+        表版本一次往返, 缓存条目一次MGET, 回填一个pipeline; 批量模式不使用single-flight租约
+        loader: 可选的批量回源函数, 参数为未命中的kwargs列表, 返回等长的结果列表
+        """
+        kwargs_list = list(kwargs_list)
+        results = [None] * len(kwargs_list)
+        tables = mapping.get_general_dependent_tables(func_name, category)
+        cached = []
+        for index, kwargs in enumerate(kwargs_list):
+            code_map = _make_code_map(key_map, kwargs)
+            if not code_map:
+                results[index] = _func(**kwargs)
+                continue
+            key = "{}:{}".format(category, gen_key((func_name, make_args_key((), kwargs))))
+            cached.append((index, key, format_final_tables(tables, code_map)))
+        if not cached:
+            return results
+
+        tickets = [gen_ticket(values) for values in
+                   get_many_tables_last_modify([data_tables for _, _, data_tables in cached])]
+        entries = get_many_cache_data([key for _, key, _ in cached])
+        misses = []
+        for (index, key, _), ticket in zip(cached, tickets):
+            data = entries.get(key)
+            if data and data.get("ticket", None) == ticket:
+                results[index] = data.get("data", None)
+            else:
+                misses.append((index, key, ticket))
+        stats.incr_route(stats_name, stats_keys.HITS, len(cached) - len(misses))
+        stats.incr_route(stats_name, stats_keys.MISSES, len(misses))
+        LOG.info("many {} cache: {} hit, {} miss".format(func_name, len(cached) - len(misses), len(misses)))
+        if not misses:
+            stats.maybe_flush()
+            return results
+
+        try:
+            if loader:
+                values = loader([kwargs_list[index] for index, _, _ in misses])
+                if len(values) != len(misses):
+                    raise ValueError("{} batch loader returned {} results, {} expected".format(
+                        func_name, len(values), len(misses)))
+            else:
+                values = [_func(**kwargs_list[index]) for index, _, _ in misses]
+            fills, negatives = [], []
+            for (index, key, ticket), value in zip(misses, values):
+                results[index] = value
+                if value:
+                    fills.append((key, value, ticket))
+                elif negative_timeout:
+                    negatives.append((key, value, ticket))
+            set_many_cache_data(fills, timeout)
+            set_many_cache_data(negatives, negative_timeout)
+            stats.incr_route(stats_name, stats_keys.FILLS, len(fills) + len(negatives))
+        finally:
+            stats.maybe_flush()
+        return results
+
+    wrapper.many = many
     return wrapper
 
 
-def dependant_cache(key_map, dependents, category=CATEGORY_INNER):
+def dependant_cache(key_map, dependents, category=CATEGORY_INNER, timeout=3600 * 4, negative_timeout=None):
+    """
+    negative_timeout: 空结果(None, [], {}等)的缓存时间, 默认不缓存空结果
+    被装饰函数抛出的异常直接向上传递
+    批量调用: func.many([kwargs, ...], loader=None)
+    """
     def decorating_function(_func):
-        wrapper = _dependant_cache_wrapper(_func, key_map, category, dependents)
+        wrapper = _dependant_cache_wrapper(_func, key_map, category, dependents, timeout, negative_timeout)
         return functools.update_wrapper(wrapper, _func)
 
     return decorating_function
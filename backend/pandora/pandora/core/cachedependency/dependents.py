@@ -23,6 +23,56 @@ REFRESH_EVERY_GET_ITEMS = [ITEM_CURRENT_DATE]
 
 Node = namedtuple("Node", ("level", "item"))
 Match = namedtuple("Match", ("route", "pattern", "compile"))
+SegmentPattern = namedtuple("SegmentPattern", ("pattern", "compile"))
+
+
+class RouteNode(object):
+    """
+    路由分段前缀树节点: 静态分段走dict, 带参数分段按注册顺序逐个匹配
+    """
+    __slots__ = ("static", "params", "matches")
+
+    def __init__(self):
+        self.static = {}
+        self.params = []
+        self.matches = []
+
+    def insert(self, components, match):
+        node = self
+        for component in components:
+            if "<" not in component:
+                node = node.static.setdefault(component, RouteNode())
+                continue
+            for pattern, child in node.params:
+                if pattern.pattern == component:
+                    node = child
+                    break
+            else:
+                regex_component, _ = route_to_regex(component, is_endpoint=True)
+                child = RouteNode()
+                node.params.append((SegmentPattern(component, re.compile(regex_component)), child))
+                node = child
+        if match not in node.matches:
+            node.matches.append(match)
+
+    def search(self, components, path, index=0):
+        if index == len(components):
+            for match in self.matches:
+                if match.compile.match(path):
+                    return match.route
+            return False
+        component = components[index]
+        child = self.static.get(component)
+        if child is not None:
+            route = child.search(components, path, index + 1)
+            if route:
+                return route
+        for pattern, child in self.params:
+            if pattern.compile.match(component):
+                route = child.search(components, path, index + 1)
+                if route:
+                    return route
+        return False
 
 
 class Dependents(object):
@@ -34,6 +84,7 @@ class Dependents(object):
         self.TABLE_LEVELS = {}
         self.PATH_KEYS = []
         self.PATH_ROUTE_MAP = {}
+        self.ROUTE_TREE = RouteNode()
 
     def get_dependants_all_items(self, keys=None):
         result = {k: [] for k in LEVEL_SET}
@@ -44,7 +95,7 @@ class Dependents(object):
         for key, tables in self.DEPENDENTS_MAP.items():
             if key not in keys:
                 continue
-            for level, table in tables:
+            for table, level in tables:
                 if table not in result[level]:
                     result[level].append(table)
         return result
@@ -71,8 +122,19 @@ class Dependents(object):
             path_routes = len_path_routes[key]
             if route not in path_routes:
                 path_routes.append(match)
+        self.ROUTE_TREE.insert(new_route, match)
 
+    @lru_cache(maxsize=8192)
     def match_path(self, path):
+        """
+        按分段前缀树匹配, 复杂度与路径分段数相关, 与注册的路由数量无关
+        """
+        return self.ROUTE_TREE.search(path.strip("/").split("/"), path)
+
+    def match_path_linear(self, path):
+        """
+        逐个正则匹配的旧实现, 保留用于基准对比
+        """
         named_path_components = []
         new_path = path.strip("/").split("/")
         new_route_len = len(new_path)
@@ -116,14 +178,15 @@ class Dependents(object):
             for item in dependent.item:
                 self.TABLE_LEVELS.setdefault(item, [])
                 table_level = self.TABLE_LEVELS[item]
-                if item not in table_level:
+                if level not in table_level:
                     table_level.append(level)
                 items.append([item, level])
                 level_item[level].append(item)
 
         self.DEPENDENTS_LEVEL_ITEM_MAP[key] = level_item
         self.DEPENDENTS_MAP[key] = items
-        self.get_api_company_dependent_tables.cache_clear()
+        self.match_path.cache_clear()
+        self.get_route_company_dependent_tables.cache_clear()
 
     def get_api_dependent_tables(self, path):
         route = self.match_path(path)
@@ -135,17 +198,32 @@ class Dependents(object):
         key = "{}:{}".format(CATEGORY_API, route)
         return key in self.DEPENDENTS_MAP
 
+    def get_api_company_dependent_tables(self, company_id, path):
+        route = self.match_path(path)
+        if not route:
+            return ()
+        return self.get_route_company_dependent_tables(route, company_id)
+
     @lru_cache(maxsize=65536)
-    def get_api_company_dependent_tables(self, company_id, path, ):
-        tables = self.get_api_dependent_tables(path)
+    def get_route_company_dependent_tables(self, route, company_id):
+        """
+        按路由模板和公司缓存, 条目数与 路由数x公司数 相关, 与具体URL无关; 返回不可变的元组
+        """
+        tables = self.DEPENDENTS_MAP.get("{}:{}".format(CATEGORY_API, route), [])
         data_tables = []
         for table in tables:
             name, level = table
             if level == LEVEL_ALL:
-                data_tables.append([name, level, ""])
+                data_tables.append((name, level, ""))
             elif level == LEVEL_COMPANY:
-                data_tables.append([name, level, company_id])
-        return data_tables
+                data_tables.append((name, level, company_id))
+        return tuple(data_tables)
+
+    def get_cache_info(self):
+        return {
+            "match_path": self.match_path.cache_info()._asdict(),
+            "route_company_tables": self.get_route_company_dependent_tables.cache_info()._asdict(),
+        }
 
     def get_link_dependent_tables(self, key):
         key = "{}:{}".format(CATEGORY_LINK, key)
@@ -160,8 +238,8 @@ class Dependents(object):
             key = "{}:{}".format(category, key)
         return self.DEPENDENTS_MAP.get(key, [])
 
-    def get_dependent_items(self, keys):
-        all_items = self.get_dependants_all_items(",".join(keys))
+    def get_dependent_items(self, keys=None):
+        all_items = self.get_dependants_all_items(",".join(keys) if keys else None)
         return all_items
 
     @property
@@ -175,3 +253,26 @@ class Dependents(object):
 
     def get_table_levels(self, table):
         return self.TABLE_LEVELS.get(table, [])
+
+    def get_graph(self):
+        """
+        依赖关系图: 注册key -> [(表, level)], 以及表 -> 引用它的注册key
+        """
+        mappings = {}
+        tables = {}
+        for key, items in self.DEPENDENTS_MAP.items():
+            category, name = key.split(":", 1)
+            mappings[key] = {
+                "category": category,
+                "name": name,
+                "tables": [(table, level) for table, level in items],
+            }
+            for table, level in items:
+                info = tables.setdefault(table, {"levels": list(self.TABLE_LEVELS.get(table, [])), "keys": []})
+                if key not in info["keys"]:
+                    info["keys"].append(key)
+        return {
+            "mappings": mappings,
+            "tables": tables,
+        }
+
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import atexit
+import time
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+import logging
+
+LOG = logging.getLogger(__name__)
+
+STATS_ON = getattr(settings, "API_CACHE_STATS_ON", True)
+FLUSH_INTERVAL = getattr(settings, "API_CACHE_STATS_FLUSH_INTERVAL", 10)
+
+ROUTE_STATS_KEY = "API_CACHE_STATS:ROUTE"
+TABLE_STATS_KEY = "API_CACHE_STATS:TABLE"
+
+HITS = "hits"
+MISSES = "misses"
+STALE = "stale"
+NOT_MODIFIED = "not_modified"
+FILLS = "fills"
+FILL_BYTES = "fill_bytes"
+REDIS_TIME = "redis_time"
+
+ROUTE_METRICS = [HITS, MISSES, STALE, NOT_MODIFIED, FILLS, FILL_BYTES, REDIS_TIME]
+
+
+class CacheStats(object):
+    """
+    进程内缓存统计, 按路由模板(或函数名)和表记录; 定期把增量合并到Redis供全局查看
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes = {}
+        self.tables = {}
+        self._pending_routes = {}
+        self._pending_tables = {}
+        self._last_flush = time.monotonic()
+
+    def incr_route(self, route, metric, value=1):
+        if not STATS_ON or not route:
+            return
+        with self._lock:
+            for routes in (self.routes, self._pending_routes):
+                item = routes.setdefault(route, dict.fromkeys(ROUTE_METRICS, 0))
+                item[metric] += value
+
+    def incr_tables(self, tables):
+        if not STATS_ON:
+            return
+        with self._lock:
+            for table in tables:
+                for counter in (self.tables, self._pending_tables):
+                    counter[table] = counter.get(table, 0) + 1
+
+    @contextmanager
+    def redis_timer(self, route):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.incr_route(route, REDIS_TIME, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "routes": {route: dict(item) for route, item in self.routes.items()},
+                "tables": dict(self.tables),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+            self.tables.clear()
+            self._pending_routes.clear()
+            self._pending_tables.clear()
+
+    def maybe_flush(self):
+        if not STATS_ON or time.monotonic() - self._last_flush < FLUSH_INTERVAL:
+            return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            routes, self._pending_routes = self._pending_routes, {}
+            tables, self._pending_tables = self._pending_tables, {}
+        if not routes and not tables:
+            return
+        from .cache import cache, get_redis_client
+        try:
+            pipe = get_redis_client().pipeline(transaction=False)
+            route_key = cache.make_key(ROUTE_STATS_KEY)
+            for route, item in routes.items():
+                for metric, value in item.items():
+                    if not value:
+                        continue
+                    field = "{}|{}".format(route, metric)
+                    if isinstance(value, float):
+                        pipe.hincrbyfloat(route_key, field, value)
+                    else:
+                        pipe.hincrby(route_key, field, value)
+            table_key = cache.make_key(TABLE_STATS_KEY)
+            for table, value in tables.items():
+                pipe.hincrby(table_key, table, value)
+            pipe.execute()
+        except Exception as e:
+            LOG.error("flush api cache stats failed, {}".format(e))
+
+
+stats = CacheStats()
+# 进程退出时合并最后一个周期内的增量
+atexit.register(stats.flush)
+
+
+def get_global_stats():
+    """
+    读取所有worker合并到Redis的统计
+    """
+    from .cache import cache, get_redis_client
+    redis = get_redis_client()
+    routes = {}
+    for field, value in redis.hgetall(cache.make_key(ROUTE_STATS_KEY)).items():
+        route, metric = field.decode().rsplit("|", 1)
+        item = routes.setdefault(route, dict.fromkeys(ROUTE_METRICS, 0))
+        item[metric] = float(value) if metric == REDIS_TIME else int(value)
+    tables = {field.decode(): int(value) for field, value in redis.hgetall(cache.make_key(TABLE_STATS_KEY)).items()}
+    return {
+        "routes": routes,
+        "tables": tables,
+    }
+
+
+def reset_global_stats():
+    from .cache import cache, get_redis_client
+    get_redis_client().delete(cache.make_key(ROUTE_STATS_KEY), cache.make_key(TABLE_STATS_KEY))
+    stats.reset()
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import hashlib
+import json
 
 
 def gen_ticket(values):
@@ -23,3 +24,29 @@ def make_params_key(values):
 
 def check_ticket(ticket, values):
     return ticket == gen_ticket(values)
+
+
+def _encode_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    if isinstance(value, bytes):
+        return value.hex()
+    meta = getattr(value, "_meta", None)
+    if meta is not None and hasattr(value, "pk"):
+        return "{}:{}".format(meta.label, value.pk)
+    return "{}:{}".format(type(value).__name__, value)
+
+
+def encode_params(value):
+    """
+    参数的规范化编码: dict按键排序, set排序, 模型实例用label+pk, 与dict的插入顺序无关
+    """
+    try:
+        return json.dumps(value, sort_keys=True, separators=(",", ":"), default=_encode_default, ensure_ascii=False)
+    except TypeError:
+        # dict的键类型混杂时无法排序, 退回repr
+        return repr(value)
+
+
+def make_args_key(args, kwargs):
+    return make_params_key([encode_params(args), "##", encode_params(kwargs)])
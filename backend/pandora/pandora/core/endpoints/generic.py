@@ -14,7 +14,7 @@ from rest_framework.serializers import Serializer
 from rest_framework.permissions import IsAuthenticated
 from pandora.core.handler import finalize_response_handler
 from pandora.core.exceptions import NotAuthenticated, PermissionDenied
-from pandora.core.permissions import ActivePermission
+from pandora.core.permissions import ActivePermission, compile_permissions
 from pandora.core.response import APIResponse
 import pandora.core.schema.manual as ms
 from pandora.core.code import NOT_FOUND
@@ -161,6 +161,30 @@ class GenericAPIView(InitialView, generics.GenericAPIView):
             "request": getattr(self, "request", None)
         }
 
+    @classmethod
+    def compile_permission_evaluator(cls):
+        """
+        as_view时把permission_classes和permission_classes_groups编译为一个短路求值函数
+        """
+        groups = getattr(cls, "permission_classes_groups", None)
+        cls._permission_evaluator = (cls.permission_classes, groups, compile_permissions(cls.permission_classes, groups))
+
+    def get_permission_evaluator(self):
+        groups = getattr(self, "permission_classes_groups", None)
+        cached = getattr(self, "_permission_evaluator", None)
+        if cached and cached[0] is self.permission_classes and cached[1] is groups:
+            return cached[2]
+        # 实例上覆盖了权限配置(例如as_view传入permission_classes), 按实际配置编译
+        return compile_permissions(self.permission_classes, groups)
+
+    def check_permissions(self, request):
+        if type(self).get_permissions is not GenericAPIView.get_permissions:
+            # 覆盖了get_permissions(例如按action区分权限)时, 编译结果不代表实际权限, 使用DRF默认逻辑
+            return super(GenericAPIView, self).check_permissions(request)
+        ret, message, code = self.get_permission_evaluator()(request, self)
+        if not ret:
+            self.permission_denied(request, message=message, code=code)
+
     def permission_denied(self, request, message=None, code=None):
         if not request.successful_authenticator:
             raise NotAuthenticated()
@@ -347,6 +371,7 @@ class ViewMixin:
 
     @classmethod
     def as_view(cls, **initkwargs):
+        cls.compile_permission_evaluator()
         if isinstance(getattr(cls, "queryset", None), models.query.QuerySet):
             def force_evaluation():
                 raise RuntimeError(
@@ -406,4 +431,7 @@ class APIGenericView(ViewMixin, GenericAPIView):
 
 
 class GenericViewSet(vs.ViewSetMixin, GenericAPIView):
-    pass
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        cls.compile_permission_evaluator()
+        return super(GenericViewSet, cls).as_view(actions, **initkwargs)
@@ -17,3 +17,7 @@ def get_project_label_header(request):
     if isinstance(label, str):
         label = label.encode(HTTP_HEADER_ENCODING)
     return label
+
+
+def get_project_label(request):
+    return get_project_label_header(request).decode(HTTP_HEADER_ENCODING)
@@ -2,12 +2,13 @@
 from __future__ import unicode_literals
 from django.utils.deprecation import MiddlewareMixin
 from django.http import HttpResponse
-from pandora.core.code import AUTHENTICATION_FAILED
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.renderers import JSONRenderer
+from pandora.core.exceptions import AuthenticationFailed
 from pandora.core.header import get_company_header, get_project_label_header
 from django.utils.functional import SimpleLazyObject
 from pandora.business.company import get_company_object
+from pandora.business.auth import get_remote_ip
 import logging
 
 LOG = logging.getLogger(__name__)
@@ -17,27 +18,38 @@ def get_company(request):
     company_id = get_company_header(request).decode()
     company = None
     if company_id:
-        company = get_company_object(company_id)
+        company = get_company_object(company_id, get_remote_ip(request))
     return company, True if company_id else False
 
 
+def company_error_response(exc):
+    """
+    中间件中解析公司失败时的响应, 与视图中抛出AuthenticationFailed的返回一致
+    """
+    return HttpResponse(JSONRenderer().render(data=exc.detail), content_type="application/json")
+
+
+def get_company_id(request):
+    """
+    按需解析公司, 不访问公司的请求不产生任何开销
+    """
+    if not hasattr(request, "_cached_company_id"):
+        company = request.company
+        request._cached_company_id = company.uid if company else None
+    return request._cached_company_id
+
+
 class CompanyMiddleware(MiddlewareMixin):
     def process_request(self, request):
-        try:
-            request.company = SimpleLazyObject(lambda: self._get_company(request))
-            if request.company:
-                request.company_id = request.company.uid
-            else:
-                request.company_id = None
-        except Exception as e:
-            LOG.error(e)
-            ret = {
-                "code": AUTHENTICATION_FAILED,
-                "message": _("获取公司信息失败")
-            }
-            return HttpResponse(JSONRenderer().render(data=ret), content_type="application/json")
+        # 保持惰性, 只有访问request.company时才查询公司; no_company的接口不产生开销
+        request.company = SimpleLazyObject(lambda: self._get_company(request))
 
     def _get_company(self, request):
         if not hasattr(request, "_cached_company"):
-            request._cached_company, request._error_company = get_company(request)
+            try:
+                request._cached_company, request._error_company = get_company(request)
+            except Exception as e:
+                # 公司不存在或id格式错误时get_company返回None; 数据库/Redis故障不能当作未传公司, 返回认证失败
+                LOG.error(e)
+                raise AuthenticationFailed(_("获取公司信息失败"))
         return request._cached_company
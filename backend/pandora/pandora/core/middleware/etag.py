@@ -11,6 +11,8 @@ from django.utils.deprecation import MiddlewareMixin
 from django.utils.cache import cc_delim_re, get_conditional_response, set_response_etag
 
 from pandora.core.cachedependency import client
+from pandora.core.exceptions import AuthenticationFailed
+from pandora.core.middleware.company import get_company_id, company_error_response
 from pandora.utils.fileutils import get_url_path_md5
 
 LOG = logging.getLogger(__name__)
@@ -27,23 +29,59 @@ class ConditionalEtagCacheMiddleware(MiddlewareMixin):
                 md5 = get_url_path_md5(path)
                 if md5:
                     etag = quote_etag(md5)
-            else:
-                if settings.API_CACHE_ON:
-                    company_id = request.company_id
+            elif settings.API_CACHE_ON:
+                company_id = None
+                tables = None
+                # 先判断路由和请求方法, 不缓存的请求不解析公司
+                if client.can_cache(company_id, request.user, path, request.method):
+                    try:
+                        company_id = get_company_id(request)
+                    except AuthenticationFailed as e:
+                        return company_error_response(e)
                     tables = client.mapping.get_api_company_dependent_tables(company_id, path)
-                    if client.can_cache(company_id, request.user, path, request.method) and tables:
-                        LOG.info("can cache")
+                if tables:
+                    LOG.info("can cache")
+                    route = client.mapping.match_path(path)
+                    setattr(request, "cache_route", route)
+                    with client.stats.redis_timer(route):
                         values = client.get_tables_last_modify(tables)
-                        LOG.debug("dependents: {}".format(values))
-                        ticket = client.gen_ticket(values)
-                        etag = quote_etag(ticket)
-                        full_path = request.get_full_path()
-                        ret, response = client.get_api_cache_data(company_id, full_path, ticket)
+                    LOG.debug("dependents: {}".format(values))
+                    ticket = client.gen_ticket(values)
+                    etag = quote_etag(ticket)
+                    # 客户端ETag一致时直接返回304, 不读取缓存的响应体
+                    response = get_conditional_response(request, etag=etag)
+                    if response:
+                        client.stats.incr_route(route, client.stats_keys.NOT_MODIFIED)
+                        return response
+                    full_path = request.get_full_path()
+                    # 回填阶段直接复用, 不再重复计算表版本和ticket
+                    setattr(request, "cache_ticket", ticket)
+                    setattr(request, "cache_full_path", full_path)
+                    with client.stats.redis_timer(route):
+                        ret, response = client.get_api_cache_data(company_id, full_path, ticket,
+                                                                  client.MAX_STALE)
+                    if ret:
+                        LOG.info("hit cache: {}".format(full_path))
+                    elif client.SINGLE_FLIGHT_ON:
+                        stale, response = response, None
+                        lease = client.acquire_api_cache_lease(company_id, full_path, ticket)
+                        if lease:
+                            setattr(request, "cache_lease", lease)
+                        elif stale is not None:
+                            # 其他worker正在回源, 返回旧数据, 不带新ticket的ETag
+                            LOG.info("stale cache: {}".format(full_path))
+                            client.stats.incr_route(route, client.stats_keys.STALE)
+                            setattr(request, "etag", None)
+                            return stale
+                        else:
+                            ret, response = client.wait_api_cache_data(company_id, full_path, ticket)
                         if not ret:
                             LOG.info("miss cache: {}".format(full_path))
                             setattr(request, "missing_cache", True)
-                        else:
-                            LOG.info("hit cache: {}".format(full_path))
+                    else:
+                        LOG.info("miss cache: {}".format(full_path))
+                        setattr(request, "missing_cache", True)
+                    client.stats.incr_route(route, client.stats_keys.HITS if ret else client.stats_keys.MISSES)
 
             setattr(request, "etag", etag)
             if etag:
@@ -56,6 +94,16 @@ class ConditionalEtagCacheMiddleware(MiddlewareMixin):
                     return response
 
     def process_response(self, request, response):
+        try:
+            return self.process_cache_response(request, response)
+        finally:
+            lease = getattr(request, "cache_lease", None)
+            if lease:
+                client.release_cache_lease(lease)
+            if getattr(request, "cache_route", None):
+                client.stats.maybe_flush()
+
+    def process_cache_response(self, request, response):
         # It"s too late to prevent an unsafe request with a 412 response, and
         # for a HEAD request, the response body is always empty so computing
         # an accurate ETag isn"t possible.
@@ -70,26 +118,20 @@ class ConditionalEtagCacheMiddleware(MiddlewareMixin):
                 return response
             etag = getattr(request, "etag", None)
             missing_cache = getattr(request, "missing_cache", False)
-            if missing_cache:
-                company_id = request.company_id
-                path = request.path
-                tables = client.mapping.get_api_dependent_tables(company_id, path)
-                if tables:
-                    values = client.get_tables_last_modify(tables)
-                    LOG.debug("dependents: {}".format(values))
-                    ticket = client.gen_ticket(values)
-                    full_path = request.get_full_path()
-                    if "json" in response["Content-Type"]:
-                        client.set_api_cache_data(company_id, full_path, ticket,
-                                                  response.data["data"],
-                                                  response.headers)
-                    etag = quote_etag(ticket)
+            if missing_cache and not response.streaming and "json" in response["Content-Type"]:
+                route = getattr(request, "cache_route", None)
+                with client.stats.redis_timer(route):
+                    size = client.set_api_cache_data(get_company_id(request), request.cache_full_path,
+                                                     request.cache_ticket, response.content, response.items())
+                if size:
+                    client.stats.incr_route(route, client.stats_keys.FILLS)
+                    client.stats.incr_route(route, client.stats_keys.FILL_BYTES, size)
             if self.needs_cache(response) and not response.has_header("ETag"):
                 if etag:
                     response["ETag"] = etag
                 elif not response.streaming:
                     etag = quote_etag(hashlib.md5(response.content).hexdigest())
-                    response["ETag"] = quote_etag(hashlib.md5(response.content).hexdigest())
+                    response["ETag"] = etag
                     response = get_conditional_response(
                         request,
                         etag=etag,
@@ -0,0 +1,168 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import logging
+from collections import OrderedDict
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.fields.related import ManyToOneRel, ManyToManyRel, OneToOneRel
+from django.db.models.signals import m2m_changed
+from pandora.core.signal import post_soft_delete
+
+__all__ = [
+    "SoftDeleteCollector",
+]
+
+LOG = logging.getLogger(__name__)
+
+SOFT_DELETE_CHUNK_SIZE = getattr(settings, "SOFT_DELETE_CHUNK_SIZE", 1000)
+
+
+def chunks(values, size):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class SoftDeleteCollector(object):
+    """
+    集合式软删除: 先按关系计算出完整的级联范围, 再按模型分块执行
+    UPDATE ... SET is_deleted=1 WHERE pk IN (...), 不再逐个实例保存和发送post_save
+    每个模型删除后发送一次post_soft_delete(sender=model, rows=[...]), 缓存失效在接收方合并处理
+    非CoreModel的模型(如MPTT树)仍调用其自身的delete(), 保持原有语义
+    """
+
+    def __init__(self, using, chunk_size=SOFT_DELETE_CHUNK_SIZE):
+        self.using = using
+        self.chunk_size = chunk_size
+        # model -> OrderedDict(pk -> 删除前的行数据)
+        self.data = OrderedDict()
+        self.field_updates = []
+        self.m2m_clears = []
+        self.fallbacks = []
+
+    @staticmethod
+    def is_collectable(model):
+        from .core import CoreModel
+        return issubclass(model, CoreModel)
+
+    @staticmethod
+    def get_null_fields(model):
+        """
+        软删除时需要置空的外键, 与原先逐个实例删除时一致, 不包含多表继承的父指针和不可为空的字段
+        """
+        if not model.is_cascade:
+            return []
+        fields = []
+        for field in model._meta.local_fields:
+            if not isinstance(field, models.ForeignKey) or not field.null:
+                continue
+            if isinstance(field, models.OneToOneField) and field.remote_field.parent_link:
+                continue
+            fields.append(field)
+        return fields
+
+    @staticmethod
+    def get_row_fields(model):
+        names = [model._meta.pk.attname]
+        for field in model._meta.concrete_fields:
+            if isinstance(field, models.ForeignKey) or field.attname in ("client_id", "company_id"):
+                names.append(field.attname)
+        for related_object in model._meta.related_objects:
+            if isinstance(related_object, ManyToOneRel):
+                names.append(related_object.field.target_field.attname)
+        return list(OrderedDict.fromkeys(names))
+
+    def add(self, queryset):
+        """
+        收集queryset中尚未收集的行, 返回新增行
+        """
+        model = queryset.model
+        pk_name = model._meta.pk.attname
+        collected = self.data.setdefault(model, OrderedDict())
+        new_rows = []
+        for row in queryset.using(self.using).order_by().values(*self.get_row_fields(model)):
+            if row[pk_name] in collected:
+                continue
+            collected[row[pk_name]] = row
+            new_rows.append(row)
+        return new_rows
+
+    def collect(self, queryset):
+        """
+        广度优先展开级联关系, 返回queryset本身命中的行数
+        """
+        root_rows = self.add(queryset)
+        pending = [(queryset.model, root_rows)]
+        while pending:
+            model, rows = pending.pop(0)
+            if not rows or not model.is_cascade:
+                continue
+            for related_object in model._meta.related_objects:
+                related_model = related_object.related_model
+                if isinstance(related_object, ManyToManyRel):
+                    pks = [row[model._meta.pk.attname] for row in rows]
+                    self.m2m_clears.append((model, related_object, pks))
+                    continue
+                if not isinstance(related_object, ManyToOneRel):
+                    continue
+                field = related_object.field
+                values = [row[field.target_field.attname] for row in rows]
+                values = [value for value in values if value is not None]
+                if not values:
+                    continue
+                if related_object.on_delete == models.CASCADE:
+                    for chunk in chunks(values, self.chunk_size):
+                        queryset = related_model._default_manager.using(self.using).filter(
+                            **{"{}__in".format(field.name): chunk})
+                        if self.is_collectable(related_model):
+                            pending.append((related_model, self.add(queryset)))
+                        else:
+                            self.fallbacks.append(queryset)
+                elif related_object.on_delete == models.SET_NULL and not isinstance(related_object, OneToOneRel):
+                    self.field_updates.append((related_model, field.name, values))
+        return len(root_rows)
+
+    def clear_m2m(self, model, related_object, pks):
+        """
+        与原先的.clear()一致: 有m2m_changed接收者时逐个实例clear, 发送pre_clear/post_clear;
+        否则按块直接删除中间表记录(中间表的post_delete照常发送)
+        """
+        field = related_object.field
+        through = field.remote_field.through
+        if m2m_changed.has_listeners(through):
+            accessor = related_object.get_accessor_name()
+            for chunk in chunks(pks, self.chunk_size):
+                for instance in model._base_manager.using(self.using).filter(pk__in=chunk):
+                    getattr(instance, accessor).clear()
+            return
+        field_name = field.m2m_reverse_field_name()
+        for chunk in chunks(pks, self.chunk_size):
+            through._base_manager.using(self.using).filter(**{"{}__in".format(field_name): chunk}).delete()
+
+    def delete(self):
+        with transaction.atomic(using=self.using, savepoint=False):
+            for model, rows in self.data.items():
+                if not rows:
+                    continue
+                LOG.info("delete instances: {}: {}".format(model.__name__, len(rows)))
+                values = {field.name: None for field in self.get_null_fields(model)}
+                values["is_deleted"] = True
+                for chunk in chunks(rows.keys(), self.chunk_size):
+                    model._base_manager.using(self.using).filter(pk__in=chunk).update(**values)
+            for related_model, field_name, values in self.field_updates:
+                for chunk in chunks(values, self.chunk_size):
+                    try:
+                        with transaction.atomic(using=self.using):
+                            related_model._default_manager.using(self.using).filter(
+                                **{"{}__in".format(field_name): chunk}).update(**{field_name: None})
+                    except Exception as e:
+                        LOG.error(e)
+            for model, related_object, pks in self.m2m_clears:
+                self.clear_m2m(model, related_object, pks)
+            for queryset in self.fallbacks:
+                queryset.delete()
+            for model, rows in self.data.items():
+                if rows:
+                    post_soft_delete.send(sender=model, rows=list(rows.values()), using=self.using)
@@ -11,6 +11,7 @@ from django.utils.translation import ugettext_lazy as _
 from mptt.managers import TreeManager
 from mptt import utils
 from mptt.exceptions import InvalidMove
+from .deletion import SoftDeleteCollector
 
 __all__ = [
     "BaseSet",
@@ -69,6 +70,10 @@ class BaseQuerySet(QuerySet):
             collector = Collector(using=del_query.db)
             collector.collect(del_query)
             deleted, _rows_count = collector.delete()
+        elif SoftDeleteCollector.is_collectable(del_query.model):
+            collector = SoftDeleteCollector(using=del_query.db)
+            _rows_count = collector.collect(del_query)
+            collector.delete()
         else:
             _rows_count = 0
             for instance in del_query:
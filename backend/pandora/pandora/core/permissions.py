@@ -2,9 +2,10 @@
 from __future__ import unicode_literals
 
 import inspect
-import operator
-from rest_framework.permissions import BasePermission
-from pandora.models.collection import UserRoleSet
+from rest_framework.permissions import BasePermission, SAFE_METHODS
+from pandora.models.collection import UserRoleSet, ActionMode
+from pandora.core.header import get_project_label
+from pandora.business.permission import has_permission_mode
 
 
 class GroupPermission(BasePermission):
@@ -16,16 +17,18 @@ class GroupPermission(BasePermission):
 
     def __init__(self):
         self.message = None
+        self.code = None
 
     def has_permission(self, request, view):
         permission_groups = getattr(view, 'permission_classes_groups', [])
+        message, code = None, None
         for permission_group in permission_groups:
-            ret, message = self.check_permission_group(permission_group, request, view)
+            ret, message, code = self.check_permission_group(permission_group, request, view)
             if ret:
-                self.message = None
+                self.message, self.code = None, None
                 return True
 
-        self.message = message
+        self.message, self.code = message, code
         return False
 
     def check_permission_group(self, permissions, request, view):
@@ -33,9 +36,10 @@ class GroupPermission(BasePermission):
             for permission in permissions:
                 if not permission().has_permission(request, view):
                     message = getattr(permission, 'message', None)
-                    return False, message
+                    code = getattr(permission, 'code', None)
+                    return False, message, code
 
-        return True, None
+        return True, None, None
 
 
 class OpBasePermission(BasePermission):
@@ -48,18 +52,18 @@ class OpBasePermission(BasePermission):
 
 class And(OpBasePermission):
     def has_permission(self, request, view):
-        result = True
         for component in self.components:
-            result = operator.iand(result, component.has_permission(request, view))
-        return result
+            if not component.has_permission(request, view):
+                return False
+        return True
 
 
 class Or(OpBasePermission):
     def has_permission(self, request, view):
-        result = False
         for component in self.components:
-            result = operator.ior(result, component.has_permission(request, view))
-        return result
+            if component.has_permission(request, view):
+                return True
+        return False
 
 
 class Not(OpBasePermission):
@@ -106,3 +110,170 @@ class DeveloperPermission(BasePermission):
     def has_permission(self, request, view):
         user_role = getattr(request.user, "role", None) if request.user else None
         return request.user and request.user.is_active and user_role == UserRoleSet.DEVELOPER
+
+
+class CatalogPermission(BasePermission):
+    """
+    菜单/模块授权校验, 读取物化的用户权限位
+    视图定义catalog_permission = (类别, url参数名), 项目取自APP_HEADER
+    安全方法需要读权限, 其他方法需要写权限
+    """
+
+    def has_permission(self, request, view):
+        category, lookup_kwarg = getattr(view, "catalog_permission", (None, None))
+        object_id = view.kwargs.get(lookup_kwarg) if lookup_kwarg else None
+        client_id = get_project_label(request)
+        if not category or object_id is None or not client_id:
+            return False
+        if not (request.user and request.user.is_authenticated):
+            return False
+        mode = ActionMode.READ if request.method in SAFE_METHODS else ActionMode.WRITE
+        return has_permission_mode(request.user.pk, client_id, category, object_id, mode)
+
+
+def _evaluate_all(funcs):
+    if len(funcs) == 1:
+        return funcs[0]
+
+    def evaluate(request, view):
+        for func in funcs:
+            if not func(request, view):
+                return False
+        return True
+
+    return evaluate
+
+
+def _evaluate_any(funcs):
+    if len(funcs) == 1:
+        return funcs[0]
+
+    def evaluate(request, view):
+        for func in funcs:
+            if func(request, view):
+                return True
+        return False
+
+    return evaluate
+
+
+def _evaluate_not(func):
+    def evaluate(request, view):
+        return not func(request, view)
+
+    return evaluate
+
+
+def _always(request, view):
+    return True
+
+
+def _never(request, view):
+    return False
+
+
+def _flatten(op_class, components, groups):
+    funcs = []
+    for component in components:
+        if type(component) is op_class:
+            funcs.extend(_flatten(op_class, component.components, groups))
+        else:
+            funcs.append(compile_permission(component, groups))
+    return funcs
+
+
+def compile_permission_groups(groups):
+    """
+    permission_classes_groups编译为 任一组全部通过 的短路求值
+    """
+    funcs = []
+    for group in groups:
+        if not isinstance(group, (list, tuple)):
+            # 与GroupPermission一致, 非列表的组视为通过
+            return _always
+        funcs.append(_evaluate_all([compile_permission(permission, groups) for permission in group]))
+    if not funcs:
+        return _never
+    return _evaluate_any(funcs)
+
+
+def compile_permission(permission, groups=None):
+    """
+    把权限类或And/Or/Not组合编译为has_permission(request, view)形式的函数
+    权限类只实例化一次, 要求权限类无请求状态; groups为None时GroupPermission在请求时读取view的配置
+    """
+    if inspect.isclass(permission):
+        if issubclass(permission, GroupPermission) and groups is not None:
+            return compile_permission_groups(groups)
+        permission = permission()
+    if isinstance(permission, GroupPermission) and groups is not None:
+        return compile_permission_groups(groups)
+    if isinstance(permission, And):
+        return _evaluate_all(_flatten(And, permission.components, groups))
+    if isinstance(permission, Or):
+        return _evaluate_any(_flatten(Or, permission.components, groups))
+    if isinstance(permission, Not):
+        return _evaluate_not(compile_permission(permission.components[0], groups))
+    return permission.has_permission
+
+
+def _compile_group_details(groups):
+    """
+    与GroupPermission一致: 任一组全部通过即通过, 否则返回最后一组中未通过的权限的message和code
+    """
+    compiled = []
+    for group in groups:
+        if not isinstance(group, (list, tuple)):
+            return _always_detail
+        compiled.append([(compile_permission(permission, groups), getattr(permission, "message", None),
+                          getattr(permission, "code", None)) for permission in group])
+
+    def evaluate(request, view):
+        message, code = None, None
+        for checks in compiled:
+            for func, message, code in checks:
+                if not func(request, view):
+                    break
+            else:
+                return True, None, None
+        return False, message, code
+
+    return evaluate
+
+
+def _always_detail(request, view):
+    return True, None, None
+
+
+def _with_detail(func, message, code):
+    def evaluate(request, view):
+        if func(request, view):
+            return True, None, None
+        return False, message, code
+
+    return evaluate
+
+
+def compile_permissions(permission_classes, groups=None):
+    """
+    编译视图的permission_classes, 返回evaluate(request, view) -> (是否通过, message, code)
+    message和code与DRF逐个检查时传给permission_denied的一致
+    """
+    checks = []
+    for permission in permission_classes:
+        is_group = isinstance(permission, GroupPermission) or (
+            inspect.isclass(permission) and issubclass(permission, GroupPermission))
+        if is_group and groups is not None:
+            checks.append(_compile_group_details(groups))
+        else:
+            checks.append(_with_detail(compile_permission(permission, groups), getattr(permission, "message", None),
+                                       getattr(permission, "code", None)))
+
+    def evaluate(request, view):
+        for check in checks:
+            ret, message, code = check(request, view)
+            if not ret:
+                return False, message, code
+        return True, None, None
+
+    return evaluate
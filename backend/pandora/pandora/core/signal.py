@@ -1,3 +1,6 @@
 import django.dispatch
 
 message_channel = django.dispatch.Signal(providing_args=["instance", "table", "event"], use_caching=True)
+
+# 集合式软删除后按模型发送一次, rows为删除前的行数据(主键, 外键, client_id, company_id)
+post_soft_delete = django.dispatch.Signal()
@@ -1,5 +1,10 @@
+import datetime
+import msgpack
 from django.contrib.auth.models import AnonymousUser
-from pandora.models.collection import CommonStatus, VirtualUserRoleSet, InterfacePermissionSet
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject, empty
+from pandora.models import User, Token
+from pandora.models.collection import VirtualUserRoleSet
 from pandora.business.base import get_object_info
 
 
@@ -43,3 +48,111 @@ class ClientUser(AnonymousUser):
     def is_authenticated(self):
         return self.is_auth
 
+
+
+class CachedPrincipal(object):
+    """
+    token缓存中保存的精简身份信息, msgpack序列化, 代替pickle完整的User和Token
+    """
+    __slots__ = ("uid", "role", "is_active", "is_staff", "is_superuser",
+                 "token_uid", "token_key", "token_create_time", "remote_ip")
+
+    VERSION = 2
+
+    def __init__(self, uid, role, is_active, is_staff, is_superuser,
+                 token_uid, token_key, token_create_time, remote_ip):
+        self.uid = uid
+        self.role = role
+        self.is_active = is_active
+        self.is_staff = is_staff
+        self.is_superuser = is_superuser
+        self.token_uid = token_uid
+        self.token_key = token_key
+        self.token_create_time = token_create_time
+        self.remote_ip = remote_ip
+
+    @classmethod
+    def from_token(cls, token):
+        user = token.user
+        return cls(user.uid, user.role, user.is_active, user.is_staff, user.is_superuser,
+                   token.uid, token.key, token.create_time.timestamp(), token.remote_ip)
+
+    def pack(self):
+        return msgpack.packb([self.VERSION] + [getattr(self, name) for name in self.__slots__])
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        数据格式不符(例如旧版本pickle的(user, token))时返回None
+        """
+        if not isinstance(data, bytes):
+            return None
+        try:
+            values = msgpack.unpackb(data)
+        except Exception:
+            return None
+        if not isinstance(values, list) or not values or values[0] != cls.VERSION:
+            return None
+        if len(values) != len(cls.__slots__) + 1:
+            return None
+        return cls(*values[1:])
+
+    def get_user(self):
+        return LazyPrincipalObject(lambda: User.objects.get(uid=self.uid), {
+            "uid": self.uid,
+            "pk": self.uid,
+            "role": self.role,
+            "is_active": self.is_active,
+            "is_staff": self.is_staff,
+            "is_superuser": self.is_superuser,
+            "is_authenticated": True,
+            "is_anonymous": False,
+        })
+
+    def get_token(self):
+        create_time = datetime.datetime.fromtimestamp(self.token_create_time, tz=timezone.utc)
+        return LazyPrincipalObject(lambda: Token.objects.get(uid=self.token_uid), {
+            "uid": self.token_uid,
+            "pk": self.token_uid,
+            "key": self.token_key,
+            "create_time": create_time,
+            "remote_ip": self.remote_ip,
+            "user_id": self.uid,
+        })
+
+
+class LazyPrincipalObject(SimpleLazyObject):
+    """
+    缓存中已有的字段直接返回, 访问其他字段时才从数据库加载完整的模型实例
+    """
+
+    def __init__(self, func, fields):
+        self.__dict__["_fields"] = fields
+        super(LazyPrincipalObject, self).__init__(func)
+
+    def __getattr__(self, name):
+        if self._wrapped is empty and name in self._fields:
+            return self._fields[name]
+        if self._wrapped is empty:
+            self._setup()
+        return getattr(self._wrapped, name)
+
+    def __bool__(self):
+        return True
+
+    def __copy__(self):
+        if self._wrapped is empty:
+            return type(self)(self._setupfunc, self._fields)
+        return super(LazyPrincipalObject, self).__copy__()
+
+    def __deepcopy__(self, memo):
+        if self._wrapped is empty:
+            result = type(self)(self._setupfunc, dict(self._fields))
+            memo[id(self)] = result
+            return result
+        return super(LazyPrincipalObject, self).__deepcopy__(memo)
+
+    def __str__(self):
+        if self._wrapped is empty:
+            self._setup()
+        return str(self._wrapped)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from django.core.management.base import BaseCommand, CommandError
+from pandora.core.cachedependency import client
+from pandora.core.cachedependency.dependents import CATEGORY_API
+from pandora.core.cachedependency.stats import get_global_stats, ROUTE_METRICS
+
+
+def get_stats_name(key, category, name):
+    # API统计按路由模板记录, 函数缓存按"分类:函数名"记录
+    return name if category == CATEGORY_API else key
+
+
+def analyze_api_cache_graph(min_hit_rate=0.2, min_requests=1):
+    """
+    合并依赖关系图与运行时统计, 按命中率从低到高排序, 低效的注册排在前面
+    """
+    graph = client.mapping.get_graph()
+    data = get_global_stats()
+    refreshes = data["tables"]
+    rows = []
+    for key, mapping in graph["mappings"].items():
+        item = data["routes"].get(get_stats_name(key, mapping["category"], mapping["name"]),
+                                  dict.fromkeys(ROUTE_METRICS, 0))
+        served = item["hits"] + item["not_modified"] + item["stale"]
+        requests = served + item["misses"]
+        tables = list(dict.fromkeys(table for table, _ in mapping["tables"]))
+        invalidations = sum(refreshes.get(table.upper(), 0) for table in tables)
+        hit_rate = float(served) / requests if requests else 0.0
+        reasons = []
+        if requests < min_requests:
+            reasons.append("unused")
+        elif hit_rate < min_hit_rate:
+            reasons.append("low_hit_rate")
+        if requests and invalidations >= requests:
+            reasons.append("invalidated_per_request")
+        rows.append({
+            "key": key,
+            "category": mapping["category"],
+            "name": mapping["name"],
+            "tables": mapping["tables"],
+            "requests": requests,
+            "served": served,
+            "misses": item["misses"],
+            "fills": item["fills"],
+            "hit_rate": hit_rate,
+            "invalidations": invalidations,
+            "redis_time": item["redis_time"],
+            "dead": bool(reasons),
+            "reasons": reasons,
+        })
+    rows.sort(key=lambda row: (row["hit_rate"], -row["invalidations"], row["requests"]))
+    tables = {}
+    for table, info in graph["tables"].items():
+        tables[table] = dict(info, refresh=refreshes.get(table.upper(), 0))
+    return {
+        "mappings": rows,
+        "tables": tables,
+    }
+
+
+def show_api_cache_graph(stdout, min_hit_rate=0.2, min_requests=1, dead_only=False, as_json=False):
+    data = analyze_api_cache_graph(min_hit_rate, min_requests)
+    if dead_only:
+        data["mappings"] = [row for row in data["mappings"] if row["dead"]]
+    if as_json:
+        stdout.write(json.dumps(data, indent=2, sort_keys=True))
+        return
+    stdout.write("{:<70}{:>10}{:>10}{:>10}{:>12}  {}\n".format(
+        "key", "requests", "hit_rate", "refresh", "redis_ms", "reasons"), ending="")
+    for row in data["mappings"]:
+        stdout.write("{:<70}{:>10}{:>10.2%}{:>10}{:>12.1f}  {}\n".format(
+            row["key"], row["requests"], row["hit_rate"], row["invalidations"], row["redis_time"] * 1000,
+            ",".join(row["reasons"])), ending="")
+        for table, level in row["tables"]:
+            stdout.write("    {:<66}level={}\n".format(table, level), ending="")
+    if dead_only:
+        return
+    stdout.write("\n{:<60}{:>10}{:>10}  {}\n".format("table", "levels", "refresh", "keys"), ending="")
+    for table, info in sorted(data["tables"].items(), key=lambda item: item[1]["refresh"], reverse=True):
+        stdout.write("{:<60}{:>10}{:>10}  {}\n".format(
+            table, ",".join(str(level) for level in info["levels"]), info["refresh"], len(info["keys"])), ending="")
+
+
+class Command(BaseCommand):
+    help = "dump route -> table -> level dependency graph and rank cache registrations by effectiveness"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-hit-rate",
+            dest="min_hit_rate",
+            type=float,
+            help="registrations below this hit rate are reported as dead",
+            default=0.2,
+        )
+        parser.add_argument(
+            "--min-requests",
+            dest="min_requests",
+            type=int,
+            help="registrations with fewer requests are reported as unused",
+            default=1,
+        )
+        parser.add_argument(
+            "--dead",
+            action="store_true",
+            dest="dead",
+            help="only show dead registrations",
+            default=False,
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            dest="json",
+            help="output json",
+            default=False,
+        )
+
+    def handle(self, *args, **options):
+        try:
+            show_api_cache_graph(self.stdout, options["min_hit_rate"], options["min_requests"], options["dead"],
+                                 options["json"])
+        except Exception as e:
+            raise CommandError(e)
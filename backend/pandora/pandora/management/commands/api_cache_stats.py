@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from django.core.management.base import BaseCommand, CommandError
+from pandora.core.cachedependency.stats import get_global_stats, reset_global_stats
+
+
+def show_api_cache_stats(stdout, as_json=False):
+    data = get_global_stats()
+    if as_json:
+        stdout.write(json.dumps(data, indent=2, sort_keys=True))
+        return
+    stdout.write("{:<60}{:>10}{:>10}{:>8}{:>8}{:>8}{:>12}{:>10}\n".format(
+        "route", "hits", "misses", "304", "stale", "fills", "fill_bytes", "redis_ms"), ending="")
+    routes = sorted(data["routes"].items(), key=lambda item: item[1]["hits"] + item[1]["misses"], reverse=True)
+    for route, item in routes:
+        stdout.write("{:<60}{:>10}{:>10}{:>8}{:>8}{:>8}{:>12}{:>10.1f}\n".format(
+            route, item["hits"], item["misses"], item["not_modified"], item["stale"], item["fills"],
+            item["fill_bytes"], item["redis_time"] * 1000), ending="")
+    stdout.write("\n{:<60}{:>10}\n".format("table", "refresh"), ending="")
+    for table, count in sorted(data["tables"].items(), key=lambda item: item[1], reverse=True):
+        stdout.write("{:<60}{:>10}\n".format(table, count), ending="")
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            dest="json",
+            help="output json",
+            default=False,
+        )
+        parser.add_argument(
+            "--reset",
+            action="store_true",
+            dest="reset",
+            help="reset api cache stats",
+            default=False,
+        )
+
+    def handle(self, *args, **options):
+        try:
+            if options["reset"]:
+                reset_global_stats()
+                self.stdout.write("reset api cache stats finish\n", ending="")
+                return
+            show_api_cache_stats(self.stdout, options["json"])
+        except Exception as e:
+            raise CommandError(e)
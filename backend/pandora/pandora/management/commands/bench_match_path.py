@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import timeit
+from django.core.management.base import BaseCommand, CommandError
+from pandora.core.cachedependency import dependents as dp
+
+
+def build_mapping(count):
+    mapping = dp.Dependents()
+    paths = []
+    for i in range(count):
+        mapping.register(route="/api/<str:version>/module{}/item/".format(i),
+                         dependents=[dp.Node(level=dp.LEVEL_COMPANY, item=["Module{}".format(i)])])
+        mapping.register(route="/api/<str:version>/module{}/item/<int:pk>/".format(i),
+                         dependents=[dp.Node(level=dp.LEVEL_COMPANY, item=["Module{}".format(i)])])
+        paths.append("/api/v2/module{}/item/".format(i))
+        paths.append("/api/v2/module{}/item/{}/".format(i, 1000 + i))
+    paths.append("/api/v2/unknown/item/")
+    return mapping, paths
+
+
+def bench_match_path(stdout, count, number):
+    mapping, paths = build_mapping(count)
+    for path in paths:
+        if mapping.match_path(path) != mapping.match_path_linear(path):
+            raise CommandError("matcher mismatch: {}".format(path))
+
+    def run_linear():
+        for path in paths:
+            mapping.match_path_linear(path)
+
+    def run_tree():
+        mapping.match_path.cache_clear()
+        for path in paths:
+            mapping.match_path(path)
+
+    def run_cached():
+        for path in paths:
+            mapping.match_path(path)
+
+    calls = number * len(paths)
+    for name, func in (("linear", run_linear), ("tree", run_tree), ("tree+lru", run_cached)):
+        seconds = timeit.timeit(func, number=number)
+        stdout.write("{:<10}{:>10.2f} us/path\n".format(name, seconds * 1000000 / calls), ending="")
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-c",
+            "--count",
+            dest="count",
+            type=int,
+            default=200,
+            help="registered api count",
+        )
+        parser.add_argument(
+            "-n",
+            "--number",
+            dest="number",
+            type=int,
+            default=20,
+            help="repeat number",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("bench match_path start\n", ending="")
+        bench_match_path(self.stdout, options["count"], options["number"])
+        self.stdout.write("bench match_path finish\n", ending="")
@@ -5,9 +5,10 @@ from django.core.management.base import BaseCommand, CommandError
 from pandora.core.cachedependency import client
 
 
-def reset_api_cache(stdout, keys):
+def reset_api_cache(stdout, keys, epoch=True):
     tables = client.mapping.get_dependent_items(keys)
-    ret = client.refresh_all_cache_tables(tables)
+    ret = client.refresh_all_cache_tables(tables, epoch)
+    stdout.write("LEVEL_COMPANY: {}\n".format(ret[client.LEVEL_COMPANY]), ending="")
     stdout.write("LEVEL_ALL: {}\n".format(ret[client.LEVEL_ALL]), ending="")
 
 
@@ -24,6 +25,13 @@ class Command(BaseCommand):
             action="store",
             help=help_str,
         )
+        parser.add_argument(
+            "--pipeline",
+            action="store_true",
+            dest="pipeline",
+            help="refresh every company table version instead of the table epoch",
+            default=False,
+        )
 
     def handle(self, *args, **options):
         self.stdout.write("reset all api_cache start\n", ending="")
@@ -32,7 +40,7 @@ class Command(BaseCommand):
             key = options["api"]
             if key not in api_keys:
                 raise CommandError("need right api")
-            reset_api_cache(self.stdout, [key])
+            reset_api_cache(self.stdout, [key], not options["pipeline"])
         except Exception as e:
             self.stdout.write("reset all api_cache failed\n", ending="")
             raise CommandError(e)
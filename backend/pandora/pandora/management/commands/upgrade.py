@@ -17,11 +17,9 @@ sync_plan_cache = {}
 def reset_api_cache(stdout):
     from pandora.core.cachedependency import client
     stdout.write("reset all api_cache start\n", ending="")
-    tables = client.mapping.get_dependent_items()
-    ret = client.refresh_all_cache_tables(tables)
-    stdout.write("LEVEL_COMPANY: {}\n".format(ret[client.LEVEL_COMPANY]), ending="")
-    stdout.write("LEVEL_ALL: {}\n".format(ret[client.LEVEL_ALL]), ending="")
-    stdout.write("LEVEL_COMPANY_SN: {}\n".format(ret[client.LEVEL_COMPANY_SN]), ending="")
+    # 递增全局epoch, 一次写入使全部API缓存失效
+    epoch, = client.refresh_epoch()
+    stdout.write("GLOBAL EPOCH: {}\n".format(epoch), ending="")
     stdout.write("reset all api_cache stop\n", ending="")
 
 
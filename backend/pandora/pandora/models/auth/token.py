@@ -36,6 +36,10 @@ class Token(ExtraCoreModel):
         # https://github.com/encode/django-rest-framework/issues/705
         verbose_name = _("Token")
         verbose_name_plural = _("Tokens")
+        indexes = [
+            models.Index(fields=["key", "create_time"], name="token_key_create_time_idx"),
+            models.Index(fields=["create_time"], name="token_create_time_idx"),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.key:
@@ -28,6 +28,10 @@ worker_max_memory_per_child = 500000
 disable_rate_limit = True
 
 beat_schedule = {
+    "reap_expired_tokens": {
+        "task": "pandora.scheduler.tasks.token.reap_expired_tokens",
+        "schedule": datetime.timedelta(minutes=10),
+    },
 }
 
 task_queues = (
@@ -37,5 +41,5 @@ task_queues = (
 )
 
 task_routes = {
-
+    "pandora.scheduler.tasks.token.reap_expired_tokens": {"queue": "beat", "routing_key": "beat"},
 }
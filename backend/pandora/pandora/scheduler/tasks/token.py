@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+from django.conf import settings
+from pandora.scheduler.celery_app import capp
+from pandora.business.token import reap_expired_tokens as _reap_expired_tokens
+import logging
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["reap_expired_tokens"]
+
+EXPIRE_MINUTES = getattr(settings, "REST_FRAMEWORK_TOKEN_EXPIRE_MINUTES", 60)
+REAPER_CHUNK_SIZE = getattr(settings, "TOKEN_REAPER_CHUNK_SIZE", 1000)
+
+
+@capp.task(name="pandora.scheduler.tasks.token.reap_expired_tokens", ignore_result=True)
+def reap_expired_tokens():
+    deleted = _reap_expired_tokens(EXPIRE_MINUTES, REAPER_CHUNK_SIZE)
+    LOG.info("reap expired tokens: {}".format(deleted))
+    return deleted
@@ -1 +1,3 @@
 from .base import *
+from .permission import *
+from .account import *
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import logging
+from django.dispatch import receiver
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from pandora.models import User
+from pandora.core.signal import post_soft_delete
+from pandora.core.authentication import SIGNED_TOKEN_ON
+from pandora.utils.cacheutils import revoke_user_signed_tokens
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["user_deactivate_handler", "user_delete_handler", "user_soft_delete_handler"]
+
+
+def _revoke_on_commit(uids):
+    # 签名token不查询数据库, 用户禁用/删除后需要撤销已签发的token; 提交后撤销, 覆盖提交前签发的token
+    if not SIGNED_TOKEN_ON:
+        return
+    uids = [uid for uid in uids if uid]
+
+    def revoke():
+        for uid in uids:
+            revoke_user_signed_tokens(uid)
+    transaction.on_commit(revoke)
+
+
+@receiver(post_save, sender=User, dispatch_uid="user_deactivate_receiver")
+def user_deactivate_handler(sender, instance, update_fields=None, *args, **kwargs):
+    if update_fields is not None and "is_active" not in update_fields:
+        return
+    if not instance.is_active:
+        _revoke_on_commit([instance.uid])
+
+
+@receiver(post_delete, sender=User, dispatch_uid="user_delete_receiver")
+def user_delete_handler(sender, instance, *args, **kwargs):
+    _revoke_on_commit([instance.uid])
+
+
+@receiver(post_soft_delete, sender=User, dispatch_uid="user_soft_delete_receiver")
+def user_soft_delete_handler(sender, rows, *args, **kwargs):
+    _revoke_on_commit([row["uid"] for row in rows])
@@ -4,17 +4,22 @@ from __future__ import absolute_import, unicode_literals
 
 import logging
 from django.dispatch import receiver
+from django.db import transaction
 from django.db.models.signals import post_delete, post_save
-from pandora.core.signal import message_channel
-from pandora.utils.cacheutils import delete_object_info_cache
+from pandora.core.signal import message_channel, post_soft_delete
+from pandora.core.cachedependency.dependents import LEVEL_ALL, LEVEL_COMPANY
+from pandora.utils.cacheutils import delete_object_info_cache, delete_object_info_caches
 from pandora.core.cachedependency import client
 from pandora.core.message import InnerMessage
 from pandora.core.message.client import message_client
 from pandora.utils.common import tohex
+from pandora.models import Company
+from pandora.business.company import invalidate_company_object
 
 LOG = logging.getLogger(__name__)
 
-__all__ = ["message_channel_handler", "app_broad_delete_handler", "app_broad_save_handler"]
+__all__ = ["message_channel_handler", "app_broad_delete_handler", "app_broad_save_handler",
+           "app_broad_soft_delete_handler", "company_change_handler", "company_soft_delete_handler"]
 
 
 # app_board.send(sender=ExamClassroom, instance=None, table="ExamClassroom", event="modify")
@@ -72,3 +77,39 @@ def app_broad_save_handler(sender, instance, signal, *args, **kwargs):
     # body = get_object_info(instance._meta.model, instance.pk, field="pk")
     # message = InnerMessage(table=table, event=event, body=body)
     # message_client.send_push(message._asdict())
+
+
+@receiver(post_soft_delete, dispatch_uid="soft_delete_receiver")
+def app_broad_soft_delete_handler(sender, rows, *args, **kwargs):
+    # 一次集合式软删除只做一次批量缓存删除, 表版本按(表, 公司)去重后提交时刷新
+    mode_name = sender.__name__
+    delete_object_info_caches(mode_name, [tohex(row["uid"]) for row in rows if row.get("uid")])
+    delete_object_info_caches(mode_name, list({row["client_id"] for row in rows if row.get("client_id")}))
+
+    table = sender.__name__
+    for level in client.mapping.get_table_levels(table):
+        if level == LEVEL_COMPANY:
+            company_field = "uid" if table in ["Company"] else "company_id"
+            for company_id in {row.get(company_field) for row in rows}:
+                if company_id:
+                    client.refresh_table_on_commit(table, code=company_id, level=LEVEL_COMPANY)
+        elif level == LEVEL_ALL:
+            client.refresh_table_on_commit(table, "", level)
+
+
+@receiver(post_save, sender=Company, dispatch_uid="company_save_receiver")
+@receiver(post_delete, sender=Company, dispatch_uid="company_delete_receiver")
+def company_change_handler(sender, instance, *args, **kwargs):
+    # 提交后再失效, 避免其他请求在提交前重新缓存旧数据
+    uid = instance.uid
+    transaction.on_commit(lambda: invalidate_company_object(uid))
+
+
+@receiver(post_soft_delete, sender=Company, dispatch_uid="company_soft_delete_receiver")
+def company_soft_delete_handler(sender, rows, *args, **kwargs):
+    uids = [row["uid"] for row in rows]
+
+    def invalidate():
+        for uid in uids:
+            invalidate_company_object(uid)
+    transaction.on_commit(invalidate)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+import logging
+from django.dispatch import receiver
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from pandora.models import CatalogPermissionGroup, CatalogPermissionGroupMember
+from pandora.models import CatalogPermissionGroupMenu, CatalogPermissionGroupModule
+from pandora.business import permission
+from pandora.core.signal import post_soft_delete
+
+LOG = logging.getLogger(__name__)
+
+__all__ = ["permission_previous_handler", "permission_group_change_handler", "permission_member_change_handler",
+           "permission_menu_change_handler", "permission_module_change_handler",
+           "permission_group_soft_delete_handler", "permission_member_soft_delete_handler",
+           "permission_grant_soft_delete_handler"]
+
+
+def _on_commit(func, *args):
+    # 提交后再重建, 避免读到未提交的授权; 重建失败不影响业务写入, 位图过期后会重新构建
+    def refresh():
+        try:
+            func(*args)
+        except Exception as e:
+            LOG.error("refresh permission bitmap failed, {}".format(e))
+    transaction.on_commit(refresh)
+
+
+# 保存前记录影响权限的旧字段值, 修改了组/用户/菜单/模块时旧的位图字段也需要重新计算
+PREVIOUS_FIELDS = {
+    CatalogPermissionGroup: ("client_id", ),
+    CatalogPermissionGroupMember: ("user_id", "group_id"),
+    CatalogPermissionGroupMenu: ("group_id", "menu_id"),
+    CatalogPermissionGroupModule: ("group_id", "module_id"),
+}
+
+
+@receiver(pre_save, sender=CatalogPermissionGroup, dispatch_uid="permission_group_previous_receiver")
+@receiver(pre_save, sender=CatalogPermissionGroupMember, dispatch_uid="permission_member_previous_receiver")
+@receiver(pre_save, sender=CatalogPermissionGroupMenu, dispatch_uid="permission_menu_previous_receiver")
+@receiver(pre_save, sender=CatalogPermissionGroupModule, dispatch_uid="permission_module_previous_receiver")
+def permission_previous_handler(sender, instance, *args, **kwargs):
+    instance._permission_previous = None
+    if instance._state.adding or instance.pk is None:
+        return
+    instance._permission_previous = sender._base_manager.filter(pk=instance.pk).values_list(
+        *PREVIOUS_FIELDS[sender]).first()
+
+
+def get_previous(instance):
+    """
+    与当前值不同的旧值, 未修改时返回None
+    """
+    previous = getattr(instance, "_permission_previous", None)
+    current = tuple(getattr(instance, name) for name in PREVIOUS_FIELDS[instance.__class__])
+    if previous is None or tuple(previous) == current:
+        return None
+    return previous
+
+
+@receiver(post_save, sender=CatalogPermissionGroup, dispatch_uid="permission_group_save_receiver")
+@receiver(post_delete, sender=CatalogPermissionGroup, dispatch_uid="permission_group_delete_receiver")
+def permission_group_change_handler(sender, instance, *args, **kwargs):
+    _on_commit(permission.refresh_group_permission_bitmaps, instance.uid)
+    previous = get_previous(instance)
+    if previous:
+        # 组改到其他项目, 原项目下成员的权限同样需要重建
+        _on_commit(permission.refresh_client_group_permission_bitmaps, instance.uid, previous[0])
+
+
+@receiver(post_save, sender=CatalogPermissionGroupMember, dispatch_uid="permission_member_save_receiver")
+@receiver(post_delete, sender=CatalogPermissionGroupMember, dispatch_uid="permission_member_delete_receiver")
+def permission_member_change_handler(sender, instance, *args, **kwargs):
+    members = [(instance.user_id, instance.group_id)]
+    previous = get_previous(instance)
+    if previous:
+        members.append(tuple(previous))
+    _on_commit(permission.refresh_members_permission_bitmaps, members)
+
+
+def _grant_change(instance, category, object_id):
+    _on_commit(permission.refresh_grant_permission_bitmaps, instance.group_id, category, object_id)
+    previous = get_previous(instance)
+    if previous:
+        _on_commit(permission.refresh_grant_permission_bitmaps, previous[0], category, previous[1])
+
+
+@receiver(post_save, sender=CatalogPermissionGroupMenu, dispatch_uid="permission_menu_save_receiver")
+@receiver(post_delete, sender=CatalogPermissionGroupMenu, dispatch_uid="permission_menu_delete_receiver")
+def permission_menu_change_handler(sender, instance, *args, **kwargs):
+    _grant_change(instance, permission.PERMISSION_MENU, instance.menu_id)
+
+
+@receiver(post_save, sender=CatalogPermissionGroupModule, dispatch_uid="permission_module_save_receiver")
+@receiver(post_delete, sender=CatalogPermissionGroupModule, dispatch_uid="permission_module_delete_receiver")
+def permission_module_change_handler(sender, instance, *args, **kwargs):
+    _grant_change(instance, permission.PERMISSION_MODULE, instance.module_id)
+
+
+# 集合式软删除: 每个模型一次信号, 合并后按项目批量重建
+@receiver(post_soft_delete, sender=CatalogPermissionGroup, dispatch_uid="permission_group_soft_delete_receiver")
+def permission_group_soft_delete_handler(sender, rows, *args, **kwargs):
+    _on_commit(permission.refresh_groups_permission_bitmaps, [row["uid"] for row in rows])
+
+
+@receiver(post_soft_delete, sender=CatalogPermissionGroupMember, dispatch_uid="permission_member_soft_delete_receiver")
+def permission_member_soft_delete_handler(sender, rows, *args, **kwargs):
+    _on_commit(permission.refresh_members_permission_bitmaps, [(row["user_id"], row["group_id"]) for row in rows])
+
+
+@receiver(post_soft_delete, sender=CatalogPermissionGroupMenu, dispatch_uid="permission_menu_soft_delete_receiver")
+@receiver(post_soft_delete, sender=CatalogPermissionGroupModule, dispatch_uid="permission_module_soft_delete_receiver")
+def permission_grant_soft_delete_handler(sender, rows, *args, **kwargs):
+    _on_commit(permission.refresh_groups_permission_bitmaps, {row["group_id"] for row in rows})
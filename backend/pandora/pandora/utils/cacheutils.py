@@ -1,11 +1,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import time
+from django.conf import settings
 from django.core.cache import cache
+from pandora.utils.localcache import LocalCache
 import logging
 
 LOG = logging.getLogger(__name__)
 
+TOKEN_TIMEOUT = 1200
+# 同一token两次EXPIRE续期之间的最小间隔(秒)
+TOKEN_TOUCH_INTERVAL = getattr(settings, "TOKEN_CACHE_TOUCH_INTERVAL", 60)
+
+# 进程内已验证token缓存, delete_expire_token时通过pub_sub广播失效
+# 保存msgpack序列化后的精简身份信息, 每个请求重新构造user和token对象
+token_local_cache = LocalCache("expire_token",
+                               maxsize=getattr(settings, "TOKEN_CACHE_LOCAL_MAXSIZE", 10000),
+                               timeout=getattr(settings, "TOKEN_CACHE_LOCAL_TIMEOUT", 30),
+                               enabled=getattr(settings, "TOKEN_CACHE_LOCAL_ON", False))
+# 记录本worker最近续期过的token, 只在本进程使用, 不需要跨进程失效
+token_touch_cache = LocalCache("expire_token_touch",
+                               maxsize=getattr(settings, "TOKEN_CACHE_LOCAL_MAXSIZE", 10000),
+                               timeout=TOKEN_TOUCH_INTERVAL, broadcast=False)
+
 
 def get_login_count(user):
     key = "IDAAS:LOGIN:{}".format(user)
@@ -28,19 +46,122 @@ def clear_login_count(user):
 
 
 def get_expire_token(key):
+    value = token_local_cache.get(key)
+    if value is not None:
+        return value
     token_key = f"IDAAS:TOKEN-{key}"
     value = cache.get(token_key)
+    if value:
+        token_local_cache.set(key, value)
     return value
 
 
-def set_expire_token(key, value, timeout=1200):
+def set_expire_token(key, value, timeout=TOKEN_TIMEOUT):
     token_key = f"IDAAS:TOKEN-{key}"
     cache.set(token_key, value, timeout)
+    token_local_cache.set(key, value)
+    token_touch_cache.set(key, True)
+
+
+def touch_expire_token(key, timeout=TOKEN_TIMEOUT):
+    """
+    滑动续期, 每个token每TOKEN_TOUCH_INTERVAL秒最多一次EXPIRE, 不重新序列化
+    """
+    if token_touch_cache.get(key):
+        return False
+    token_touch_cache.set(key, True)
+    token_key = f"IDAAS:TOKEN-{key}"
+    cache.expire(token_key, timeout)
+    return True
 
 
 def delete_expire_token(key):
     token_key = f"IDAAS:TOKEN-{key}"
     cache.delete(token_key)
+    token_touch_cache.delete(key)
+    token_local_cache.invalidate([key])
+
+
+def delete_expire_tokens(keys):
+    """
+    批量删除token缓存, 一次多key DEL, 本地缓存合并为一条失效广播
+    """
+    if not keys:
+        return
+    cache.delete_many([f"IDAAS:TOKEN-{key}" for key in keys])
+    token_touch_cache.delete(*keys)
+    token_local_cache.invalidate(keys)
+
+
+def get_cached_token_keys(keys):
+    """
+    返回仍在token缓存中的key集合, 一次MGET
+    """
+    if not keys:
+        return set()
+    values = cache.get_many([f"IDAAS:TOKEN-{key}" for key in keys])
+    return {key for key in keys if values.get(f"IDAAS:TOKEN-{key}")}
+
+
+SIGNED_TOKEN_EXPIRE_SECONDS = getattr(settings, "SIGNED_TOKEN_EXPIRE_MINUTES",
+                                      getattr(settings, "REST_FRAMEWORK_TOKEN_EXPIRE_MINUTES", 60)) * 60
+
+# 签名token的撤销状态, 本地缓存检查结果, 撤销时广播失效
+signed_token_revoked_cache = LocalCache("signed_token_revoked",
+                                        maxsize=getattr(settings, "TOKEN_CACHE_LOCAL_MAXSIZE", 10000),
+                                        timeout=getattr(settings, "TOKEN_CACHE_LOCAL_TIMEOUT", 30),
+                                        enabled=getattr(settings, "TOKEN_CACHE_LOCAL_ON", False))
+
+
+def set_user_signed_token_exp(uid, exp):
+    """
+    记录用户已签发签名token的最晚过期时间(秒), 用户级撤销记录保留到该时间
+    """
+    key = f"IDAAS:SIGNED-EXP-USER-{uid}"
+    timeout = int(exp - time.time())
+    if timeout > 0 and (cache.get(key) or 0) < exp:
+        cache.set(key, exp, timeout)
+
+
+def revoke_signed_token(jti, exp):
+    """
+    撤销单个签名token, 撤销记录保留到token的过期时间exp(秒)
+    """
+    timeout = int(exp - time.time())
+    if timeout <= 0:
+        return
+    cache.set(f"IDAAS:REVOKED-{jti}", 1, timeout)
+    signed_token_revoked_cache.invalidate([jti])
+
+
+def revoke_user_signed_tokens(uid, exp=None):
+    """
+    撤销用户在此之前签发的全部签名token, 记录毫秒时间
+    撤销记录保留到用户已签发token的最晚过期时间, exp为调用方已知的token过期时间(秒)
+    没有签发记录时(如升级前签发的token)按默认有效期保留
+    """
+    now = time.time()
+    latest = max(exp or 0, cache.get(f"IDAAS:SIGNED-EXP-USER-{uid}") or 0)
+    timeout = int(latest - now) if latest else SIGNED_TOKEN_EXPIRE_SECONDS
+    if timeout <= 0:
+        return
+    cache.set(f"IDAAS:REVOKED-USER-{uid}", int(now * 1000), timeout)
+    signed_token_revoked_cache.invalidate([f"USER-{uid}"])
+
+
+def is_signed_token_revoked(jti, uid, issued_ms):
+    """
+    issued_ms: token的毫秒签发时间, 严格晚于撤销时间签发的token仍然有效
+    """
+    keys = {jti: f"IDAAS:REVOKED-{jti}", f"USER-{uid}": f"IDAAS:REVOKED-USER-{uid}"}
+    data = signed_token_revoked_cache.get_many(keys.keys())
+    missing = [key for key in keys if key not in data]
+    if missing:
+        values = cache.get_many([keys[key] for key in missing])
+        for key in missing:
+            data[key] = values.get(keys[key]) or 0
+            signed_token_revoked_cache.set(key, data[key])
+    return bool(data[jti]) or data[f"USER-{uid}"] > issued_ms
 
 
 def get_object_info_cache(name, key):
@@ -57,6 +178,12 @@ def set_object_info_cache(name, key, value, timeout=36000):
 def delete_object_info_cache(name, key):
     key = f"IDAAS_OBJ_{name.upper()}:{key}"
     cache.delete(key)
+
+
+def delete_object_info_caches(name, keys):
+    if not keys:
+        return
+    cache.delete_many([f"IDAAS_OBJ_{name.upper()}:{key}" for key in keys])
     
     
 def get_company_info(key):
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import time
+import threading
+from collections import OrderedDict
+from pandora.utils.channel import PublishClient, SubscribeServer
+import logging
+
+LOG = logging.getLogger(__name__)
+
+LOCAL_CACHE_CHANNEL = "default_idaas_local_cache_channel"
+
+_registry = {}
+_subscriber = None
+_subscriber_lock = threading.Lock()
+
+
+class LocalCache(object):
+    """
+    进程内有界TTL/LRU缓存, 通过pub_sub广播失效
+    timeout为最大陈旧时间(秒), 即使丢失失效消息也不会超过该时间
+    broadcast为False时只在本进程使用, 不启动订阅线程也不发布失效消息
+    """
+
+    def __init__(self, name, maxsize=4096, timeout=5, enabled=True, broadcast=True):
+        self.name = name
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.enabled = enabled
+        self.broadcast = broadcast
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        _registry[name] = self
+
+    def get(self, key, default=None):
+        if not self.enabled:
+            return default
+        if self.broadcast:
+            ensure_subscriber()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expire_at = item
+                if expire_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+        return default
+
+    def get_many(self, keys):
+        sentinel = object()
+        result = {}
+        for key in keys:
+            value = self.get(key, sentinel)
+            if value is not sentinel:
+                result[key] = value
+        return result
+
+    def set(self, key, value, timeout=None):
+        if not self.enabled:
+            return
+        if self.broadcast:
+            ensure_subscriber()
+        expire_at = time.monotonic() + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def invalidate(self, keys=None):
+        """
+        本进程立即失效, 并广播给其他worker; keys为None时清空
+        """
+        if keys is None:
+            self.clear()
+        else:
+            self.delete(*keys)
+        if not self.enabled or not self.broadcast:
+            return
+        try:
+            PublishClient(LOCAL_CACHE_CHANNEL).publish({"name": self.name, "keys": keys})
+        except Exception as e:
+            LOG.error("publish {} invalidation failed, {}".format(self.name, e))
+
+    def info(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "enabled": self.enabled,
+                "broadcast": self.broadcast,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "timeout": self.timeout,
+            }
+
+
+def get_local_caches():
+    return dict(_registry)
+
+
+def _dispatch(message):
+    if not isinstance(message, dict):
+        return
+    local_cache = _registry.get(message.get("name"))
+    if not local_cache:
+        return
+    keys = message.get("keys")
+    if keys is None:
+        local_cache.clear()
+    else:
+        local_cache.delete(*keys)
+
+
+class _Subscriber(threading.Thread):
+    def __init__(self):
+        super(_Subscriber, self).__init__(name="local-cache-subscriber", daemon=True)
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                server = SubscribeServer(LOCAL_CACHE_CHANNEL)
+                while True:
+                    _dispatch(server.subscribe(block=True))
+            except Exception as e:
+                # 订阅中断期间无法收到失效消息, 清空本地缓存避免脏读
+                LOG.error("local cache subscriber failed, {}".format(e))
+                for local_cache in list(_registry.values()):
+                    local_cache.clear()
+                time.sleep(1)
+
+
+def ensure_subscriber():
+    """
+    每个worker进程惰性启动一个订阅线程, fork后重新启动
+    """
+    global _subscriber
+    if _subscriber is not None and _subscriber.pid == os.getpid():
+        return
+    with _subscriber_lock:
+        if _subscriber is not None and _subscriber.pid == os.getpid():
+            return
+        for local_cache in list(_registry.values()):
+            local_cache.clear()
+        _subscriber = _Subscriber()
+        _subscriber.start()
@@ -73,3 +73,21 @@ class DistributedLock(object):
     def __exit__(self, exc_type=None, exc_value=None, traceback=None):
         self._lock.release()
         LOG.info("Release the lock - {}".format(self.lock_name))
+
+
+def acquire_lease(lease_name, expire=5):
+    """
+    非阻塞获取短租约, 获取失败返回None; 租约到期自动释放
+    """
+    _lock = cache.lock("lease_{}".format(lease_name), expire=expire)
+    if _lock.acquire(blocking=False):
+        return _lock
+    return None
+
+
+def release_lease(_lock):
+    try:
+        _lock.release()
+    except Exception as e:
+        # 租约已过期或被其他进程重新获取
+        LOG.info("Release lease failed - {}".format(e))